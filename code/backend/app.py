@@ -5,7 +5,10 @@ from pages import routes
 from flask_cors import CORS
 
 import database as db
+import deadlines
+import ingest
 import opinion_clustering
+import summaries
 
 app = Flask(__name__, static_folder='../frontend/build', static_url_path='')
 app.register_blueprint(routes, url_prefix='/api')
@@ -26,5 +29,11 @@ def not_found(e):
 
 if __name__ == '__main__':
     db.init()
+    ingest.init()
     opinion_clustering.init()
+    summaries.init()
+    deadlines.init()
+    # Serve once the workers have loaded their model, so the first triggers do not queue behind it
+    if not opinion_clustering.wait_until_ready(opinion_clustering.READY_TIMEOUT):
+        print(f"Clustering workers not ready after {opinion_clustering.READY_TIMEOUT:.0f}s, serving anyway")
     app.run(host='0.0.0.0', port=FLASK_PORT)
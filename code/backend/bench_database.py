@@ -0,0 +1,202 @@
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Database benchmarks.
+#
+#   python bench_database.py lookup --calls 10000
+#       Overhead of a typical request, the session lookup every authenticated endpoint does,
+#       with a fresh connection per call (the old helpers), with the connection pool and with the
+#       session cache in front of it.
+#
+#   python bench_database.py stress --opinions 5000 --writers 8
+#       A clustering process rewrites the clusters of a large topic in a loop while poll threads
+#       insert opinions. Reports insert latencies and fails if any insert errored.
+#
+#   python bench_database.py ingest --writers 200 --inserts 5 --synchronous FULL
+#       A room submitting their opinions at once: every poll thread inserts with its own commit,
+#       then through the group-commit ingestion queue. Reports submissions per second.
+#
+#   python bench_database.py plans
+#       Runs EXPLAIN QUERY PLAN on the hot queries of a migrated database and fails if any of
+#       them scans its table instead of using an index.
+
+def fresh_connection_lookup(db_path, session_id):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("PRAGMA foreign_keys = ON;")
+    c.execute("SELECT username FROM User WHERE session_id = ?;", (session_id,))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def timed(label, calls, func):
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{label}: {elapsed / calls * 1e6:.1f}us per lookup")
+    return elapsed
+
+def lookup(db, db_path, args):
+    db.insert_user("bench", "bench-session")
+    def uncached_lookup():
+        db._session_cache.invalidate("bench-session")
+        return db.get_username_by_session_id("bench-session")
+    before = timed("fresh connection", args.calls, lambda: fresh_connection_lookup(db_path, "bench-session"))
+    pooled = timed("connection pool", args.calls, uncached_lookup)
+    cached = timed("session cache", args.calls, lambda: db.get_username_by_session_id("bench-session"))
+    print(f"Speedup: pool {before / pooled:.1f}x, cache {before / cached:.1f}x")
+    print(f"Session cache: {db.cache_stats()['sessions']}")
+
+def recluster_loop(stop, rounds):
+    import database as db
+    opinions = db.get_raw_opinions_for_topic("big")
+    while not stop.is_set():
+        # Alternate between two groupings so every round rewrites every opinion
+        size = 2 + rounds.value % 2
+        clusters = [{"heading": group[0]["opinion"], "leader_id": group[0]["username"], "raw_opinions": group}
+                    for group in (opinions[i:i + size] for i in range(0, len(opinions), size))]
+        db.replace_clusters_for_topic(clusters, "big")
+        rounds.value += 1
+
+def stress(db, db_path, args):
+    db.insert_topic("big", "stress topic", 0)
+    db.insert_topic("poll", "poll topic", 0)
+    for i in range(args.opinions):
+        db.insert_user(f"user{i}", f"session{i}")
+        db.insert_raw_opinion(f"user{i}", "big", f"opinion {i}", 1)
+
+    stop = multiprocessing.Event()
+    rounds = multiprocessing.Value('i', 0)
+    clusterer = multiprocessing.Process(target=recluster_loop, args=(stop, rounds))
+    clusterer.start()
+    while rounds.value == 0:
+        time.sleep(0.01)
+
+    latencies = []
+    errors = []
+    def writer(w):
+        for i in range(args.inserts):
+            start = time.perf_counter()
+            try:
+                db.insert_raw_opinion(f"user{(w * args.inserts + i) % args.opinions}", "poll", "late opinion", 1)
+            except sqlite3.Error as e:
+                errors.append(e)
+            latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=writer, args=(w,)) for w in range(args.writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stop.set()
+    clusterer.join()
+
+    latencies.sort()
+    print(f"{len(latencies)} poll inserts during {rounds.value} reclusterings of {args.opinions} opinions")
+    print(f"insert latency p50 {latencies[len(latencies) // 2] * 1000:.1f}ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms")
+    print(f"errors: {len(errors)}")
+    if errors:
+        raise SystemExit(f"Poll inserts failed while reclustering: {errors[0]}")
+
+def submissions_per_second(label, args, submit):
+    barrier = threading.Barrier(args.writers)
+    def writer(w):
+        barrier.wait()
+        for i in range(args.inserts):
+            submit(f"user{w}", "poll", f"opinion {w} {i}", 1)
+    threads = [threading.Thread(target=writer, args=(w,)) for w in range(args.writers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    rate = args.writers * args.inserts / (time.perf_counter() - start)
+    print(f"{label}: {rate:.0f} submissions/s")
+    return rate
+
+def ingest_bench(db, db_path, args):
+    import ingest
+    db.insert_topic("poll", "poll topic", 0)
+    for w in range(args.writers):
+        db.insert_user(f"user{w}", f"session{w}")
+    with db.connection() as conn:
+        print(f"synchronous={conn.execute('PRAGMA synchronous;').fetchone()[0]} (0 OFF, 1 NORMAL, 2 FULL)")
+
+    before = submissions_per_second("commit per submission", args, db.insert_raw_opinion)
+    ingest.init()
+    after = submissions_per_second("group commit", args, ingest.submit)
+    print(f"Speedup: {after / before:.1f}x, {ingest.stats()}")
+    if db.count_raw_opinions_for_topic("poll") != 2 * args.writers * args.inserts:
+        raise SystemExit("Submissions went missing")
+
+# (label, query, parameters, index the plan must use)
+HOT_QUERIES = [
+    ("get_raw_opinions_for_topic",
+     "SELECT raw_id, username, opinion, weight, clustered_opinion_id FROM RawOpinion WHERE uuid = ?;",
+     ("t",), "idx_raw_opinion_uuid_username"),
+    ("raw_opinion_submitted",
+     "SELECT * FROM RawOpinion WHERE username = ? AND uuid = ?;",
+     ("u", "t"), "idx_raw_opinion_uuid_username"),
+    ("is_leader",
+     "SELECT * FROM ClusteredOpinion WHERE uuid = ? AND leader_id = ?;",
+     ("t", "u"), "idx_clustered_opinion_uuid_leader"),
+    ("get_clustered_opinions_with_raw_opinions",
+     "SELECT co.cluster_id, ro.raw_id FROM ClusteredOpinion co "
+     "LEFT JOIN RawOpinion ro ON co.cluster_id = ro.clustered_opinion_id WHERE co.uuid = ?;",
+     ("t",), "idx_raw_opinion_cluster"),
+    ("get_clustering_jobs",
+     "SELECT job_id FROM ClusteringJob WHERE uuid = ? ORDER BY job_id DESC LIMIT 10;",
+     ("t",), "idx_clustering_job_uuid"),
+    ("get_chat_messages",
+     "SELECT id, message, timestamp FROM ChatMessage ORDER BY timestamp ASC LIMIT 100;",
+     (), "idx_chat_message_timestamp"),
+]
+
+def plans(db, db_path, args):
+    failures = []
+    with db.connection() as conn:
+        print(f"schema version {db.schema_version(conn)}")
+        for label, query, parameters, index in HOT_QUERIES:
+            details = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, parameters)]
+            ok = any(index in detail for detail in details)
+            print(f"{'ok  ' if ok else 'FAIL'} {label}: {'; '.join(details)}")
+            if not ok:
+                failures.append(label)
+    if failures:
+        raise SystemExit(f"Queries not using their index: {', '.join(failures)}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Database benchmarks')
+    parser.add_argument('mode', choices=['lookup', 'stress', 'ingest', 'plans'], help='Benchmark to run')
+    parser.add_argument('--calls', type=int, default=5000, help='Lookups per variant')
+    parser.add_argument('--opinions', type=int, default=5000, help='Opinions in the reclustered topic')
+    parser.add_argument('--writers', type=int, default=8, help='Concurrent poll threads')
+    parser.add_argument('--inserts', type=int, default=100, help='Inserts per poll thread')
+    parser.add_argument('--synchronous', help='Override DB_SYNCHRONOUS, e.g. FULL to fsync every commit')
+    args = parser.parse_args()
+
+    if args.synchronous:
+        os.environ["DB_SYNCHRONOUS"] = args.synchronous
+    db_path = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    os.environ["DB_FILE"] = db_path
+    import database as db
+    db.init(db_path)
+
+    if args.mode == 'lookup':
+        lookup(db, db_path, args)
+    elif args.mode == 'stress':
+        stress(db, db_path, args)
+    elif args.mode == 'ingest':
+        ingest_bench(db, db_path, args)
+    elif args.mode == 'plans':
+        plans(db, db_path, args)
+
+if __name__ == '__main__':
+    main()
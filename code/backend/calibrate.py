@@ -0,0 +1,75 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import opinion_clustering
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'documentation'))
+from cluster_test import CORPORA
+
+# Benchmarks cluster_raw_opinions for different worker counts and torch thread budgets and
+# recommends the configuration with the highest throughput on this host.
+#
+#   python calibrate.py --repeats 5
+#
+# Apply the result through CLUSTERING_WORKERS, CLUSTERING_TORCH_THREADS and CLUSTERING_CPU_AFFINITY.
+
+def bench_worker(slot, torch_threads, affinity, opinions, repeats, barrier, results):
+    cpus = opinion_clustering.cpus_for_slot(slot, torch_threads) if affinity else None
+    opinion_clustering.configure_process(torch_threads, cpus)
+    opinion_clustering.warmup_worker()
+    opinion_clustering.cluster_raw_opinions(opinions)
+
+    barrier.wait()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        opinion_clustering.cluster_raw_opinions(opinions)
+    results.put(time.perf_counter() - start)
+
+def run_setting(workers, torch_threads, affinity, opinions, repeats):
+    barrier = multiprocessing.Barrier(workers)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=bench_worker,
+                                         args=(slot, torch_threads, affinity, opinions, repeats, barrier, results))
+                 for slot in range(workers)]
+    for p in processes:
+        p.start()
+    elapsed = max(results.get() for _ in processes)
+    for p in processes:
+        p.join()
+    return workers * repeats * len(opinions) / elapsed
+
+def candidate_settings(cpu_count):
+    workers = 1
+    while workers <= cpu_count:
+        for torch_threads in sorted({1, max(1, cpu_count // workers)}):
+            yield workers, torch_threads
+        workers *= 2
+
+def main():
+    parser = argparse.ArgumentParser(description='Clustering worker CPU budget calibration')
+    parser.add_argument('--repeats', type=int, default=3, help='Clustering runs per worker and setting')
+    parser.add_argument('--affinity', action='store_true', help='Pin every worker to its own cores')
+    parser.add_argument('--corpus', default='what_blocks_you', choices=list(CORPORA.keys()), help='Corpus to use')
+    args = parser.parse_args()
+
+    opinions = [{"raw_id": i, "username": "calibrate", "opinion": text, "weight": 1}
+                for i, text in enumerate(CORPORA[args.corpus])]
+    cpu_count = os.cpu_count() or 1
+
+    results = []
+    for workers, torch_threads in candidate_settings(cpu_count):
+        throughput = run_setting(workers, torch_threads, args.affinity, opinions, args.repeats)
+        results.append((throughput, workers, torch_threads))
+        print(f"workers={workers} torch_threads={torch_threads}: {throughput:.1f} opinions/s")
+
+    throughput, workers, torch_threads = max(results)
+    print(f"\nRecommended for {cpu_count} CPUs ({throughput:.1f} opinions/s):")
+    print(f"export CLUSTERING_WORKERS={workers}")
+    print(f"export CLUSTERING_TORCH_THREADS={torch_threads}")
+    print(f"export CLUSTERING_CPU_AFFINITY={'true' if args.affinity else 'false'}")
+
+if __name__ == '__main__':
+    main()
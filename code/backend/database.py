@@ -1,10 +1,140 @@
 import sqlite3
 import os
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 
 db_file = os.getenv("DB_FILE")
+POOL_SIZE = 8 # idle connections kept per process
+
+# Pragmas. WAL lets readers and the /poll inserts continue while a clustering worker writes,
+# and with synchronous=NORMAL a commit only appends to the WAL instead of syncing the database.
+JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000")) # wait for the write lock instead of failing
+CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384")) # page cache per connection
+MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# Read caches in front of the per-request lookups
+SESSION_CACHE_SIZE = int(os.getenv("DB_SESSION_CACHE_SIZE", "4096"))
+SESSION_CACHE_TTL = float(os.getenv("DB_SESSION_CACHE_TTL", "60")) # seconds
+TOPIC_CACHE_SIZE = int(os.getenv("DB_TOPIC_CACHE_SIZE", "1024"))
+TOPIC_CACHE_TTL = float(os.getenv("DB_TOPIC_CACHE_TTL", "30")) # bounds staleness if an invalidation is missed
+
+#------- CONNECTION POOL ---------
+
+# Connections are opened once per process with the pragmas applied and then reused.
+# A forked clustering worker must not share the parent's connections, so the pool
+# remembers which process created it and starts over in a new one.
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+_pool_pid = os.getpid()
+
+def _open_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS};")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};")
+    # Negative cache_size is in KiB rather than pages
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB};")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE};")
+    return conn
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection. Commits when the block succeeds and rolls back when it raises."""
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        _pool = queue.LifoQueue(maxsize=POOL_SIZE)
+        _pool_pid = os.getpid()
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _open_connection()
+
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+#------- CACHES ---------
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire ttl seconds after they were stored."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_value(self, value):
+        """Drop every entry that maps to value."""
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[1] == value]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+# session_id -> username. The app runs in a single process, so invalidating here is enough.
+_session_cache = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+# uuid -> (content, state, deadline). Clustering workers change the state in their own process,
+# so the scheduler calls invalidate_topic when it hears a job finished.
+_topic_cache = TTLCache(TOPIC_CACHE_SIZE, TOPIC_CACHE_TTL)
+
+def invalidate_topic(uuid: str):
+    _topic_cache.invalidate(uuid)
+
+def cache_stats() -> dict:
+    return {"sessions": _session_cache.stats(), "topics": _topic_cache.stats()}
+
 
 #------- CREATE TABLE ---------
 
+# Topics.current_state values
+TOPIC_STATES = {
+    0: "question",
+    1: "loading",
+    2: "live",
+    3: "result"
+}
+
 def init(db_path=db_file):
     conn = sqlite3.connect(db_path)
     c = conn.cursor()
@@ -12,6 +142,10 @@ def init(db_path=db_file):
     # Enable foreign key enforcement
     c.execute("PRAGMA foreign_keys = ON;")
 
+    # The journal mode is stored in the database file, so setting it once covers every process
+    journal_mode = c.execute(f"PRAGMA journal_mode = {JOURNAL_MODE};").fetchone()[0]
+    print(f"Database journal mode: {journal_mode}")
+
     # ---------- User ----------
     c.execute("""
     CREATE TABLE IF NOT EXISTS User (
@@ -21,7 +155,7 @@ def init(db_path=db_file):
     """)
 
     # ---------- Topics ----------
-    # current_state uses integer as enum placeholder
+    # current_state uses integer as enum placeholder, see TOPIC_STATES
     # deadline is unix timestamp (int)
     c.execute("""
     CREATE TABLE IF NOT EXISTS Topics (
@@ -94,43 +228,108 @@ def init(db_path=db_file):
     );
     """)
 
+    # ---------- RawOpinionEmbedding ----------
+    # embedding is a float16 vector stored as raw bytes
+    # content_hash guards against reusing a vector for different text
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS RawOpinionEmbedding (
+        raw_id INTEGER,
+        model TEXT,
+        content_hash TEXT NOT NULL,
+        embedding BLOB NOT NULL,
+        PRIMARY KEY(raw_id, model),
+        FOREIGN KEY(raw_id) REFERENCES RawOpinion(raw_id)
+    );
+    """)
+
+    # ---------- ClusteringJob ----------
+    # status is one of queued, running, done, failed
+    # *_at are unix timestamps (float), timings is a JSON object of stage -> seconds
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS ClusteringJob (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        uuid TEXT NOT NULL,
+        status TEXT NOT NULL,
+        mode TEXT,
+        opinion_count INTEGER,
+        queued_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        timings TEXT,
+        error TEXT,
+        FOREIGN KEY(uuid) REFERENCES Topics(uuid)
+    );
+    """)
+
     conn.commit()
+    migrate(conn)
     conn.close()
 
 
+#------- MIGRATIONS ---------
+
+# Schema changes after the initial tables. Each entry is (version, description, statements) and
+# runs once, in its own transaction, on databases whose user_version is below its version.
+# Append new entries with the next version number; never edit one that has shipped.
+MIGRATIONS = [
+    (1, "indexes for the hot queries", [
+        # Covers uuid-only lookups as well as raw_opinion_submitted
+        "CREATE INDEX IF NOT EXISTS idx_raw_opinion_uuid_username ON RawOpinion(uuid, username);",
+        "CREATE INDEX IF NOT EXISTS idx_raw_opinion_cluster ON RawOpinion(clustered_opinion_id);",
+        "CREATE INDEX IF NOT EXISTS idx_clustered_opinion_uuid_leader ON ClusteredOpinion(uuid, leader_id);",
+        "CREATE INDEX IF NOT EXISTS idx_leader_vote_cluster ON LeaderVote(clustered_opinion_id);",
+        "CREATE INDEX IF NOT EXISTS idx_clustering_job_uuid ON ClusteringJob(uuid, job_id);",
+        "CREATE INDEX IF NOT EXISTS idx_chat_message_timestamp ON ChatMessage(timestamp);",
+    ]),
+    (2, "clustering job change counts", [
+        # Opinions assigned by an incremental job or rows rewritten by a full one, 0 if the clusters stayed the same
+        "ALTER TABLE ClusteringJob ADD COLUMN changes INTEGER;",
+    ]),
+]
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+def migrate(conn: sqlite3.Connection):
+    """Apply every migration newer than the database's user_version."""
+    current = schema_version(conn)
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            # Another process may have migrated while we waited for the write lock
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version};")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        print(f"Database migrated to version {version}: {description}")
+
+
 #------- INSERTS ---------
 
 def query_wrapper(query: str, *parameters):
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
-
     try:
-        c.execute(query, parameters)
-        conn.commit()
+        with connection() as conn:
+            conn.execute(query, parameters)
     except sqlite3.Error as e:
         print("Database error:", e)
 
-    finally:
-        conn.close()
-
 
 def query_wrapper_with_lastrowid(query: str, *parameters) -> int:
     """Query wrapper that returns the lastrowid for INSERT operations"""
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
-
     try:
-        c.execute(query, parameters)
-        lastrowid = c.lastrowid
-        conn.commit()
-        return lastrowid
+        with connection() as conn:
+            return conn.execute(query, parameters).lastrowid
     except sqlite3.Error as e:
         print("Database error:", e)
         raise e
-    finally:
-        conn.close()
 
 
 def insert_user(username: str, session_id: str):
@@ -139,6 +338,9 @@ def insert_user(username: str, session_id: str):
             INSERT OR REPLACE INTO User (username, session_id)
             VALUES (?, ?);
         """, username, session_id)
+    # The replaced row may have held this username's old session or this session for another username
+    _session_cache.invalidate_value(username)
+    _session_cache.invalidate(session_id)
 
 def insert_topic(uuid: str, content: str, deadline: int):
     query_wrapper("""
@@ -146,10 +348,11 @@ def insert_topic(uuid: str, content: str, deadline: int):
         VALUES (?, ?, ?, ?);
     """, uuid, content, 0, deadline)
     # after initialization the state must be the init state 0
+    invalidate_topic(uuid)
 
 
-def insert_raw_opinion(username: str, uuid: int, opinion: str, weight: int):
-    query_wrapper("""
+def insert_raw_opinion(username: str, uuid: int, opinion: str, weight: int) -> int:
+    return query_wrapper_with_lastrowid("""
         INSERT INTO RawOpinion (username, uuid, opinion, weight)
         VALUES (?, ?, ?, ?);
     """, username, uuid, opinion, weight)
@@ -157,6 +360,20 @@ def insert_raw_opinion(username: str, uuid: int, opinion: str, weight: int):
 
 
 
+def insert_raw_opinions(rows: list) -> list:
+    """Insert (username, uuid, opinion, weight) rows in one transaction and return their raw_ids in order"""
+    with connection() as conn:
+        # Take the write lock up front so no other insert can interleave with the batch
+        conn.execute("BEGIN IMMEDIATE;")
+        conn.executemany("""
+            INSERT INTO RawOpinion (username, uuid, opinion, weight)
+            VALUES (?, ?, ?, ?);
+        """, rows)
+        # AUTOINCREMENT hands out consecutive ids to the rows of a single writer
+        last_id = conn.execute("SELECT last_insert_rowid();").fetchone()[0]
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
 def insert_map_raw_to_clustered(raw_opinion_id: int, clustered_opinion_id: int):
     query_wrapper("""
         INSERT OR IGNORE INTO RawOpinionClusteredOpinion (raw_opinion_id, clustered_opinion_id)
@@ -170,6 +387,21 @@ def insert_leader_vote(uuid: int, username: str, clustered_opinion_id: int):
         VALUES (?, ?, ?);
     """, uuid, username, clustered_opinion_id)
 
+def advance_topic_state(uuid: str, from_state: int, to_state: int) -> bool:
+    """Move a topic to to_state, but only if it is still in from_state. Returns whether it moved."""
+    try:
+        with connection() as conn:
+            changed = conn.execute("""
+                UPDATE Topics
+                SET current_state = ?
+                WHERE uuid = ? AND current_state = ?;
+            """, (to_state, uuid, from_state)).rowcount > 0
+    except sqlite3.Error as e:
+        print("Database error:", e)
+        changed = False
+    invalidate_topic(uuid)
+    return changed
+
 def leader_vote(username: str, uuid: int, clustered_opinion_id: int):
     if is_leader(username, uuid):
         insert_leader_vote(uuid, username, clustered_opinion_id)
@@ -177,6 +409,44 @@ def leader_vote(username: str, uuid: int, clustered_opinion_id: int):
         print(f"Error. User {username} is not leader for topic {uuid}")
 
 
+def assign_raw_opinions_to_clusters(assignments: list):
+    """Set clustered_opinion_id for (cluster_id, raw_id) pairs without touching the other clusters"""
+    try:
+        with connection() as conn:
+            conn.executemany("""
+                UPDATE RawOpinion
+                SET clustered_opinion_id = ?
+                WHERE raw_id = ?;
+            """, assignments)
+    except sqlite3.Error as e:
+        print("Database error:", e)
+        raise e
+
+
+def insert_clustering_job(uuid: str, queued_at: float) -> int:
+    return query_wrapper_with_lastrowid("""
+        INSERT INTO ClusteringJob (uuid, status, queued_at)
+        VALUES (?, 'queued', ?);
+    """, uuid, queued_at)
+
+
+def start_clustering_job(job_id: int, started_at: float):
+    query_wrapper("""
+        UPDATE ClusteringJob
+        SET status = 'running', started_at = ?
+        WHERE job_id = ?;
+    """, started_at, job_id)
+
+
+def finish_clustering_job(job_id: int, status: str, finished_at: float, mode: str = None,
+                          opinion_count: int = None, timings: str = None, error: str = None, changes: int = None):
+    query_wrapper("""
+        UPDATE ClusteringJob
+        SET status = ?, finished_at = ?, mode = ?, opinion_count = ?, timings = ?, error = ?, changes = ?
+        WHERE job_id = ?;
+    """, status, finished_at, mode, opinion_count, timings, error, changes, job_id)
+
+
 def update_raw_opinion_cluster(raw_id: int, clustered_opinion_id: int):
     """Update the clustered_opinion_id for a raw opinion"""
     query_wrapper("""
@@ -186,190 +456,271 @@ def update_raw_opinion_cluster(raw_id: int, clustered_opinion_id: int):
     """, clustered_opinion_id, raw_id)
 
 
-def replace_clusters_for_topic(clusters_data: list, topic_uuid: str) -> list:
-    """Delete old clusters and insert new clusters"""
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
+def replace_clusters_for_topic(clusters_data: list, topic_uuid: str) -> tuple:
+    """
+    Write a new clustering for a topic while keeping cluster ids, leaders and leader votes stable.
+    New clusters are matched one-to-one to existing clusters by membership overlap and only rows
+    that actually change are written. Returns (cluster_ids, rows_written), one id per entry of clusters_data.
+    """
+    try:
+        with connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT cluster_id, leader_id FROM ClusteredOpinion WHERE uuid = ?;
+            """, (topic_uuid,))
+            existing = dict(c.fetchall())
+
+            c.execute("""
+                SELECT raw_id, clustered_opinion_id FROM RawOpinion WHERE uuid = ?;
+            """, (topic_uuid,))
+            current = dict(c.fetchall())
+
+            # Greedy matching, largest overlap first
+            candidates = []
+            for i, cluster_data in enumerate(clusters_data):
+                overlap = Counter(current.get(raw_opinion['raw_id']) for raw_opinion in cluster_data['raw_opinions'])
+                candidates.extend((count, i, cluster_id) for cluster_id, count in overlap.items() if cluster_id in existing)
+            matched = {}
+            for count, i, cluster_id in sorted(candidates, reverse=True):
+                if i not in matched and cluster_id not in matched.values():
+                    matched[i] = cluster_id
+
+            rows_written = 0
+            cluster_ids = []
+            changes = []
+            for i, cluster_data in enumerate(clusters_data):
+                cluster_id = matched.get(i)
+                if cluster_id is None:
+                    c.execute("""
+                        INSERT INTO ClusteredOpinion (current_heading, uuid, leader_id)
+                        VALUES (?, ?, ?);
+                    """, (cluster_data['heading'], topic_uuid, cluster_data['leader_id']))
+                    cluster_id = c.lastrowid
+                    rows_written += 1
+                elif existing[cluster_id] not in {raw_opinion['username'] for raw_opinion in cluster_data['raw_opinions']}:
+                    # The old leader left the cluster, their votes go with them below
+                    c.execute("""
+                        UPDATE ClusteredOpinion
+                        SET current_heading = ?, leader_id = ?
+                        WHERE cluster_id = ?;
+                    """, (cluster_data['heading'], cluster_data['leader_id'], cluster_id))
+                    rows_written += 1
+                cluster_ids.append(cluster_id)
+                changes.extend((cluster_id, raw_opinion['raw_id']) for raw_opinion in cluster_data['raw_opinions']
+                               if current.get(raw_opinion['raw_id']) != cluster_id)
+
+            c.executemany("""
+                UPDATE RawOpinion
+                SET clustered_opinion_id = ?
+                WHERE raw_id = ?;
+            """, changes)
+            rows_written += c.rowcount
+
+            # Drop clusters that were not matched, after releasing the opinions nobody took over
+            assigned = {raw_opinion['raw_id'] for cluster_data in clusters_data for raw_opinion in cluster_data['raw_opinions']}
+            stale = {cluster_id for cluster_id in existing if cluster_id not in cluster_ids}
+            c.executemany("""
+                UPDATE RawOpinion
+                SET clustered_opinion_id = NULL
+                WHERE raw_id = ?;
+            """, [(raw_id,) for raw_id, cluster_id in current.items() if cluster_id in stale and raw_id not in assigned])
+            rows_written += c.rowcount
+            for statement in ["DELETE FROM RawOpinionClusteredOpinion WHERE clustered_opinion_id = ?;",
+                              "DELETE FROM LeaderVote WHERE clustered_opinion_id = ?;",
+                              "DELETE FROM ClusteredOpinion WHERE cluster_id = ?;"]:
+                c.executemany(statement, [(cluster_id,) for cluster_id in stale])
+                rows_written += c.rowcount
+
+            # Votes of users who are no longer leaders of this topic
+            c.execute("""
+                DELETE FROM LeaderVote
+                WHERE uuid = ? AND username NOT IN (
+                    SELECT leader_id FROM ClusteredOpinion WHERE uuid = ?
+                );
+            """, (topic_uuid, topic_uuid))
+            rows_written += c.rowcount
+
+            return cluster_ids, rows_written
+    except sqlite3.Error as e:
+        print("Database error:", e)
+        raise e
 
-    cluster_ids = []
 
+def insert_raw_opinion_embeddings(rows: list, model: str):
+    """Store embeddings given as (raw_id, content_hash, embedding_bytes) tuples"""
     try:
-        # Delete old clusters
-        # Reset clustered_opinion_id in RawOpinion table
-        c.execute("""
-            UPDATE RawOpinion
-            SET clustered_opinion_id = NULL
-            WHERE uuid = ?;
-        """, (topic_uuid,))
+        with connection() as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO RawOpinionEmbedding (raw_id, model, content_hash, embedding)
+                VALUES (?, ?, ?, ?);
+            """, [(raw_id, model, content_hash, embedding) for raw_id, content_hash, embedding in rows])
+    except sqlite3.Error as e:
+        print("Database error:", e)
 
-        # Delete from RawOpinionClusteredOpinion mapping table
-        c.execute("""
-            DELETE FROM RawOpinionClusteredOpinion
-            WHERE clustered_opinion_id IN (
-                SELECT cluster_id FROM ClusteredOpinion WHERE uuid = ?
-            );
-        """, (topic_uuid,))
 
-        # Delete leader votes for this topic
+#------- GETTER ---------
+
+def get_raw_opinion_embeddings(topic_uuid: str, model: str) -> dict:
+    """Get cached embeddings for a topic as {raw_id: (content_hash, embedding_bytes)}"""
+    with connection() as conn:
+        c = conn.cursor()
+
         c.execute("""
-            DELETE FROM LeaderVote WHERE uuid = ?;
-        """, (topic_uuid,))
+            SELECT e.raw_id, e.content_hash, e.embedding
+            FROM RawOpinionEmbedding e
+            JOIN RawOpinion ro ON ro.raw_id = e.raw_id
+            WHERE ro.uuid = ? AND e.model = ?;
+        """, (topic_uuid, model))
+
+        rows = c.fetchall()
+
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+def get_raw_opinions_for_topic(topic_uuid: str) -> list:
+    """Get all raw opinions with raw_id, username, opinion, weight and current cluster for a topic"""
+    with connection() as conn:
+        c = conn.cursor()
 
-        # Delete clustered opinions
         c.execute("""
-            DELETE FROM ClusteredOpinion WHERE uuid = ?;
+            SELECT raw_id, username, opinion, weight, clustered_opinion_id
+            FROM RawOpinion
+            WHERE uuid = ?;
         """, (topic_uuid,))
 
-        # Insert new clusters
-        for cluster_data in clusters_data:
-            # Insert clustered opinion
-            c.execute("""
-                INSERT INTO ClusteredOpinion (current_heading, uuid, leader_id)
-                VALUES (?, ?, ?);
-            """, (cluster_data['heading'], topic_uuid, cluster_data['leader_id']))
+        rows = c.fetchall()
 
-            cluster_id = c.lastrowid
-            cluster_ids.append(cluster_id)
+    return [{"raw_id": row[0], "username": row[1], "opinion": row[2], "weight": row[3],
+             "clustered_opinion_id": row[4]} for row in rows]
 
-            # Update raw opinions to reference this cluster
-            for raw_opinion in cluster_data['raw_opinions']:
-                c.execute("""
-                    UPDATE RawOpinion
-                    SET clustered_opinion_id = ?
-                    WHERE raw_id = ?;
-                """, (cluster_id, raw_opinion['raw_id']))
+def count_raw_opinions_for_topic(topic_uuid: str) -> int:
+    with connection() as conn:
+        c = conn.cursor()
 
-        conn.commit()
-        return cluster_ids
-    except sqlite3.Error as e:
-        conn.rollback()
-        print("Database error:", e)
-        raise e
-    finally:
-        conn.close()
+        c.execute("""
+            SELECT COUNT(*) FROM RawOpinion
+            WHERE uuid = ?;
+        """, (topic_uuid,))
 
+        count = c.fetchone()[0]
+    return count
 
-#------- GETTER ---------
+def get_username_by_session_id(session_id: str) -> str|None:
+    username = _session_cache.get(session_id)
+    if username is not None:
+        return username
 
-def get_raw_opinions_for_topic(topic_uuid: str) -> list:
-    """Get all raw opinions with raw_id, username, opinion, and weight for a topic"""
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
+    with connection() as conn:
+        c = conn.cursor()
 
-    c.execute("""
-        SELECT raw_id, username, opinion, weight
-        FROM RawOpinion
-        WHERE uuid = ?;
-    """, (topic_uuid,))
+        c.execute("""
+            SELECT username FROM User
+            WHERE session_id = ?;
+        """, (session_id,))
 
-    rows = c.fetchall()
-    conn.close()
+        row = c.fetchone()
 
-    return [{"raw_id": row[0], "username": row[1], "opinion": row[2], "weight": row[3]} for row in rows]
+    # Unknown sessions are not cached, so a session is usable as soon as insert_user returns
+    if row is None:
+        return None
+    _session_cache.put(session_id, row[0])
+    return row[0]
 
-def get_username_by_session_id(session_id: str) -> str|None:
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
 
-    c.execute("""
-        SELECT username FROM User
-        WHERE session_id = ?;
-    """, (session_id,))
+def get_content_by_uuid(uuid: int) -> tuple|None: # (content, state, deadline)
+    topic = _topic_cache.get(uuid)
+    if topic is not None:
+        return topic
 
-    row = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        c = conn.cursor()
 
-    return row[0] if row else None
+        c.execute("""
+            SELECT content, current_state, deadline FROM Topics
+            WHERE uuid = ?;
+        """, (uuid,))
 
+        row = c.fetchone()
 
-def get_content_by_uuid(uuid: int) -> tuple|None: # (content, state, deadline)
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
+    if row is None:
+        return None
+    _topic_cache.put(uuid, row)
+    return row
 
-    c.execute("""
-        SELECT content, current_state, deadline FROM Topics
-        WHERE uuid = ?;
-    """, (uuid,))
+def get_topics_awaiting_deadline() -> list:
+    """Get (uuid, deadline) of topics that are still collecting opinions or waiting for their clustering"""
+    with connection() as conn:
+        c = conn.cursor()
 
-    row = c.fetchone()
-    conn.close()
+        c.execute("""
+            SELECT uuid, deadline FROM Topics
+            WHERE current_state IN (0, 1) AND deadline IS NOT NULL;
+        """)
 
-    return row if row else None
+        rows = c.fetchall()
+    return rows
 
 def raw_opinion_submitted(uuid, username) -> bool:
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
+    with connection() as conn:
+        c = conn.cursor()
 
-    c.execute("""
-        SELECT *
-        FROM RawOpinion
-        WHERE username = ? AND uuid = ?;
-    """, (uuid, username))
+        c.execute("""
+            SELECT *
+            FROM RawOpinion
+            WHERE username = ? AND uuid = ?;
+        """, (uuid, username))
 
-    exists = c.fetchone() is not None
-    conn.close()
+        exists = c.fetchone() is not None
     return exists
 
 
 def get_raw_opinions() -> list:
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
+    with connection() as conn:
+        c = conn.cursor()
 
-    c.execute("""
-        SELECT uuid, content, opinion, username, weight
-        FROM RawOpinion join Topics using(uuid);
-    """)
+        c.execute("""
+            SELECT uuid, content, opinion, username, weight
+            FROM RawOpinion join Topics using(uuid);
+        """)
 
-    result = c.fetchall()
-    conn.close()
+        result = c.fetchall()
     return result
 
 
 def is_leader(uuid: int, username: str) -> bool:
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
+    with connection() as conn:
+        c = conn.cursor()
 
-    c.execute("""
-        SELECT *
-        FROM ClusteredOpinion
-        WHERE uuid = ? AND leader_id = ?;
-    """, (uuid, username))
+        c.execute("""
+            SELECT *
+            FROM ClusteredOpinion
+            WHERE uuid = ? AND leader_id = ?;
+        """, (uuid, username))
 
-    exists = c.fetchone() is not None
-    conn.close()
+        exists = c.fetchone() is not None
     return exists
 
 
 def get_clustered_opinions_with_raw_opinions(topic_uuid: str) -> list:
     """Get all clustered opinions with their constituent raw opinions and users for a topic"""
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
+    with connection() as conn:
+        c = conn.cursor()
 
-    c.execute("""
-        SELECT 
-            co.cluster_id,
-            co.current_heading,
-            co.leader_id,
-            ro.raw_id,
-            ro.username,
-            ro.opinion,
-            ro.weight
-        FROM ClusteredOpinion co
-        LEFT JOIN RawOpinion ro ON co.cluster_id = ro.clustered_opinion_id
-        WHERE co.uuid = ?
-        ORDER BY co.cluster_id, ro.raw_id;
-    """, (topic_uuid,))
-
-    rows = c.fetchall()
-    conn.close()
+        c.execute("""
+            SELECT 
+                co.cluster_id,
+                co.current_heading,
+                co.leader_id,
+                ro.raw_id,
+                ro.username,
+                ro.opinion,
+                ro.weight
+            FROM ClusteredOpinion co
+            LEFT JOIN RawOpinion ro ON co.cluster_id = ro.clustered_opinion_id
+            WHERE co.uuid = ?
+            ORDER BY co.cluster_id, ro.raw_id;
+        """, (topic_uuid,))
+
+        rows = c.fetchall()
 
     clusters = {}
     for row in rows:
@@ -392,6 +743,34 @@ def get_clustered_opinions_with_raw_opinions(topic_uuid: str) -> list:
 
     return list(clusters.values())
 
+def get_clustering_jobs(topic_uuid: str, limit: int = 10) -> list:
+    """Get the most recent clustering jobs for a topic, newest first"""
+    with connection() as conn:
+        c = conn.cursor()
+
+        c.execute("""
+            SELECT job_id, status, mode, opinion_count, queued_at, started_at, finished_at, timings, error, changes
+            FROM ClusteringJob
+            WHERE uuid = ?
+            ORDER BY job_id DESC
+            LIMIT ?;
+        """, (topic_uuid, limit))
+
+        rows = c.fetchall()
+
+    return [{
+        "job_id": row[0],
+        "status": row[1],
+        "mode": row[2],
+        "opinion_count": row[3],
+        "queued_at": row[4],
+        "started_at": row[5],
+        "finished_at": row[6],
+        "timings": row[7],
+        "error": row[8],
+        "changes": row[9]
+    } for row in rows]
+
 def insert_chat_message(message_id: str, message: str, timestamp: int):
     """Insert a chat message"""
     query_wrapper("""
@@ -403,19 +782,17 @@ def insert_chat_message(message_id: str, message: str, timestamp: int):
 
 def get_chat_messages(limit: int = 100) -> list:
     """Get all chat messages ordered by timestamp, with optional limit"""
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
+    with connection() as conn:
+        c = conn.cursor()
 
-    c.execute("""
-        SELECT id, message, timestamp
-        FROM ChatMessage
-        ORDER BY timestamp ASC
-        LIMIT ?;
-    """, (limit,))
+        c.execute("""
+            SELECT id, message, timestamp
+            FROM ChatMessage
+            ORDER BY timestamp ASC
+            LIMIT ?;
+        """, (limit,))
 
-    rows = c.fetchall()
-    conn.close()
+        rows = c.fetchall()
 
     return [{
         "id": row[0],
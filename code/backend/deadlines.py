@@ -0,0 +1,89 @@
+import heapq
+import os
+import threading
+import time
+
+import database as db
+import events
+import opinion_clustering
+
+# Single background thread that acts on Topics.deadline: when a topic's deadline passes it moves
+# from "question" (0) to "loading" (1) and its clustering is queued. The worker that finishes the
+# clustering moves it on to "live" (2). A failed deadline clustering is retried with a growing delay;
+# after DEADLINE_MAX_RETRIES failures the topic goes live with the clusters it already has rather
+# than staying in "loading".
+
+DEADLINE_MAX_RETRIES = int(os.getenv("DEADLINE_MAX_RETRIES", "3"))
+DEADLINE_RETRY_DELAY = float(os.getenv("DEADLINE_RETRY_DELAY", "5")) # seconds, times the attempt number
+
+_heap = [] # (fire_at, topic_uuid, deadline)
+_failures = {} # topic_uuid -> failed deadline clusterings so far
+_condition = threading.Condition()
+_thread = None
+
+def init():
+    """Load every topic still waiting for its deadline and start the timer thread"""
+    global _thread
+    with _condition:
+        for topic_uuid, deadline in db.get_topics_awaiting_deadline():
+            heapq.heappush(_heap, (deadline, topic_uuid, deadline))
+    opinion_clustering.add_done_listener(_on_clustered)
+    _thread = threading.Thread(target=_run, daemon=True)
+    _thread.start()
+
+def schedule(topic_uuid, deadline):
+    _push(deadline, topic_uuid, deadline)
+
+def _run():
+    while True:
+        with _condition:
+            while not _heap or _heap[0][0] > time.time():
+                _condition.wait(timeout=_heap[0][0] - time.time() if _heap else None)
+            _, topic_uuid, deadline = heapq.heappop(_heap)
+        try:
+            _fire(topic_uuid, deadline)
+        except Exception as e:
+            # This is the only timer thread, keep it alive and try the topic again later
+            print(f"Deadline handling for {topic_uuid} failed: {e}")
+            _push(time.time() + DEADLINE_RETRY_DELAY, topic_uuid, deadline)
+
+def _push(fire_at, topic_uuid, deadline):
+    with _condition:
+        heapq.heappush(_heap, (fire_at, topic_uuid, deadline))
+        _condition.notify()
+
+def _fire(topic_uuid, deadline):
+    topic = db.get_content_by_uuid(topic_uuid)
+    # Ignore stale entries of topics that were replaced or already moved on
+    if not topic or topic[2] != deadline or topic[1] not in (0, 1):
+        return
+    if db.advance_topic_state(topic_uuid, 0, 1):
+        events.publish_topic_state(topic_uuid)
+    try:
+        opinion_clustering.trigger(topic_uuid, full=True)
+    except opinion_clustering.BacklogFull as e:
+        print(f"Deadline clustering for {topic_uuid} delayed by {e.retry_after}s: backlog full")
+        _push(time.time() + e.retry_after, topic_uuid, deadline)
+        return
+    print(f"Deadline reached for topic {topic_uuid}, clustering queued")
+
+def _on_clustered(topic_uuid):
+    """Retry the clustering of a topic left in "loading" by a failed job"""
+    topic = db.get_content_by_uuid(topic_uuid)
+    if not topic or topic[1] != 1:
+        _failures.pop(topic_uuid, None)
+        return
+    jobs = db.get_clustering_jobs(topic_uuid, limit=1)
+    if not jobs or jobs[0]["status"] != "failed":
+        return
+
+    attempts = _failures.get(topic_uuid, 0) + 1
+    if attempts > DEADLINE_MAX_RETRIES:
+        print(f"Clustering for {topic_uuid} failed {attempts} times, showing its previous clusters")
+        _failures.pop(topic_uuid, None)
+        if db.advance_topic_state(topic_uuid, 1, 2):
+            events.publish_topic_state(topic_uuid)
+        return
+    _failures[topic_uuid] = attempts
+    print(f"Deadline clustering for {topic_uuid} failed, retry {attempts} of {DEADLINE_MAX_RETRIES}")
+    _push(time.time() + DEADLINE_RETRY_DELAY * attempts, topic_uuid, topic[2])
@@ -0,0 +1,87 @@
+import json
+import os
+import queue
+import threading
+
+import database as db
+
+# Server-Sent Events fan-out. Every open /events/<uuid> stream registers a Subscriber for its topic.
+# publish() serializes an event once and drops it into the bounded queue of each subscriber, so
+# publishing never blocks on a slow client and idle subscribers cost one blocked thread and a queue.
+
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "64")) # undelivered events before a client is dropped
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "15")) # seconds between keepalives on an idle stream
+
+_subscribers = {} # topic_uuid -> set of Subscriber
+_lock = threading.Lock()
+_stats = {"published": 0, "delivered": 0, "dropped": 0}
+
+class Subscriber:
+    def __init__(self, topic_uuid):
+        self.topic_uuid = topic_uuid
+        self.queue = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.closed = False
+
+def format_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def subscribe(topic_uuid: str) -> Subscriber:
+    subscriber = Subscriber(topic_uuid)
+    with _lock:
+        _subscribers.setdefault(topic_uuid, set()).add(subscriber)
+    return subscriber
+
+def unsubscribe(subscriber: Subscriber):
+    with _lock:
+        topic_subscribers = _subscribers.get(subscriber.topic_uuid)
+        if topic_subscribers is not None:
+            topic_subscribers.discard(subscriber)
+            if not topic_subscribers:
+                del _subscribers[subscriber.topic_uuid]
+
+def publish(topic_uuid: str|None, event: str, data):
+    """Send an event to every subscriber of topic_uuid, or to every subscriber when topic_uuid is None"""
+    message = format_event(event, data)
+    with _lock:
+        if topic_uuid is None:
+            targets = [s for topic_subscribers in _subscribers.values() for s in topic_subscribers]
+        else:
+            targets = list(_subscribers.get(topic_uuid, ()))
+    _stats["published"] += 1
+    for subscriber in targets:
+        try:
+            subscriber.queue.put_nowait(message)
+            _stats["delivered"] += 1
+        except queue.Full:
+            # A client that stopped reading must not hold up the others. Its stream ends and
+            # EventSource reconnects with a fresh snapshot.
+            subscriber.closed = True
+            unsubscribe(subscriber)
+            _stats["dropped"] += 1
+
+def topic_event(topic) -> dict:
+    """Payload of a topic event, shaped like the /topic response"""
+    return {"topic": topic[0], "state": db.TOPIC_STATES[topic[1]]}
+
+def publish_topic_state(topic_uuid: str):
+    topic = db.get_content_by_uuid(topic_uuid)
+    if topic:
+        publish(topic_uuid, "topic", topic_event(topic))
+
+def stream(subscriber: Subscriber, initial=()):
+    """SSE frames for a streaming response: the initial snapshot, then published events until the client goes away"""
+    try:
+        for message in initial:
+            yield message
+        while not subscriber.closed:
+            try:
+                yield subscriber.queue.get(timeout=SSE_HEARTBEAT)
+            except queue.Empty:
+                # Comment line; also how a disconnected client is noticed
+                yield ": keepalive\n\n"
+    finally:
+        unsubscribe(subscriber)
+
+def stats() -> dict:
+    with _lock:
+        return dict(_stats, topics=len(_subscribers), subscribers=sum(len(s) for s in _subscribers.values()))
@@ -0,0 +1,91 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import database as db
+
+# Group commit for poll submissions. Request threads hand their opinion to a single writer thread
+# and block until it is committed. The writer collects submissions for up to INGEST_BATCH_WAIT
+# seconds or INGEST_BATCH_SIZE rows and inserts them with one transaction, so a burst before a
+# deadline costs one commit per batch instead of one per participant.
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "128"))
+INGEST_BATCH_WAIT = float(os.getenv("INGEST_BATCH_WAIT", "0.003")) # seconds
+
+_queue = queue.Queue()
+_thread = None
+_stats = {"submissions": 0, "batches": 0, "largest_batch": 0}
+
+class Submission:
+    def __init__(self, row):
+        self.row = row # (username, uuid, opinion, weight)
+        self.done = threading.Event()
+        self.raw_id = None
+        self.error = None
+
+def init():
+    """Start the writer thread"""
+    global _thread
+    _thread = threading.Thread(target=_run, daemon=True)
+    _thread.start()
+
+def submit(username: str, uuid: str, opinion: str, weight: int) -> int:
+    """Insert a raw opinion and return its raw_id once the insert is committed"""
+    if _thread is None:
+        return db.insert_raw_opinion(username, uuid, opinion, weight)
+    submission = Submission((username, uuid, opinion, weight))
+    _queue.put(submission)
+    submission.done.wait()
+    if submission.error is not None:
+        raise submission.error
+    return submission.raw_id
+
+def stats() -> dict:
+    return dict(_stats, queued=_queue.qsize())
+
+def _run():
+    while True:
+        batch = [_queue.get()]
+        flush_at = time.monotonic() + INGEST_BATCH_WAIT
+        while len(batch) < INGEST_BATCH_SIZE:
+            remaining = flush_at - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _flush(batch)
+
+def _flush(batch):
+    # Every submitter is blocked on its done event, so whatever happens here each one must be released
+    try:
+        _insert(batch)
+    except Exception as e:
+        print(f"Batch insert of {len(batch)} opinions failed: {e}")
+        for submission in batch:
+            if submission.raw_id is None and submission.error is None:
+                submission.error = e
+    finally:
+        _stats["submissions"] += len(batch)
+        _stats["batches"] += 1
+        _stats["largest_batch"] = max(_stats["largest_batch"], len(batch))
+        for submission in batch:
+            submission.done.set()
+
+def _insert(batch):
+    try:
+        raw_ids = db.insert_raw_opinions([submission.row for submission in batch])
+        for submission, raw_id in zip(batch, raw_ids):
+            submission.raw_id = raw_id
+    except sqlite3.IntegrityError as e:
+        # One bad row rolls back the whole batch. poll() validates session and topic first, so this
+        # is rare; retry the halves so the valid rows still share a few commits instead of one each.
+        if len(batch) == 1:
+            batch[0].error = e
+            return
+        print(f"Batch insert of {len(batch)} opinions failed ({e}), retrying in halves")
+        _insert(batch[:len(batch) // 2])
+        _insert(batch[len(batch) // 2:])
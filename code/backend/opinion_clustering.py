@@ -1,94 +1,982 @@
+import hashlib
+import importlib.util
+import heapq
+import itertools
+import json
+import math
 import multiprocessing
+import os
+import queue
+import re
+import shutil
+import threading
+import time
 import uuid
 import random
 import database as db
+import events
+import torch
 from sentence_transformers import SentenceTransformer
-from sklearn.cluster import DBSCAN, HDBSCAN
+from joblib import Parallel, delayed
+from sklearn.cluster import DBSCAN, HDBSCAN, MiniBatchKMeans
+from sklearn.decomposition import PCA
 import numpy as np
 
+EMBEDDING_MODEL = 'tencent/Youtu-Embedding'
+# torch (fp32), torch-int8 (dynamically quantized Linear layers) or onnx (exported once to MODEL_CACHE_DIR)
+EMBEDDING_BACKEND = os.getenv("CLUSTERING_EMBEDDING_BACKEND", "torch")
+EMBEDDING_BACKENDS = ("torch", "torch-int8", "onnx")
+MODEL_CACHE_DIR = '/state'
+ONNX_MODEL_FILE = os.path.join("onnx", "model.onnx") # written by SentenceTransformer.save() for the onnx backend
+NUM_WORKERS = 4 # default, overridden by CLUSTERING_WORKERS
+# Incremental assignment of late opinions to existing clusters
+INCREMENTAL_MIN_SIMILARITY = 0.6 # cosine similarity to the nearest centroid needed to join a cluster
+INCREMENTAL_MAX_NOISE = 0.3 # fraction of new opinions allowed to match no cluster before a full recluster
+INCREMENTAL_MAX_GROWTH = 0.5 # new opinions relative to already clustered ones before a full recluster
+# Dimensionality reduction before HDBSCAN, fitted per topic. Off by default: cluster agreement with the
+# full width has only been measured on corpora far below REDUCTION_MIN_OPINIONS (cluster_test.py reduce)
+REDUCTION_METHOD = os.getenv("CLUSTERING_REDUCTION", "none") # pca, truncate (Matryoshka style) or none
+REDUCTION_DIM = int(os.getenv("CLUSTERING_REDUCTION_DIM", "64"))
+REDUCTION_MIN_OPINIONS = int(os.getenv("CLUSTERING_REDUCTION_MIN_OPINIONS", "500")) # smaller topics keep full width
+# Two-level clustering for very large topics: k-means partitions, HDBSCAN per partition, merge
+PARTITION_MIN_OPINIONS = int(os.getenv("CLUSTERING_PARTITION_MIN_OPINIONS", "5000"))
+PARTITION_SIZE = 2000 # target opinions per partition
+PARTITION_MERGE_SIMILARITY = 0.9 # cosine similarity of centroids above which clusters are merged
+# Partitions clustered at the same time by one worker, each in its own joblib process. Part of the
+# CPU budget (see load_cpu_config); the default of 1 clusters them one after the other.
+PARTITION_JOBS = int(os.getenv("CLUSTERING_PARTITION_JOBS", "1"))
+# Cross-topic batching: when jobs queue up, small topics share one worker and one encode pass
+BATCH_MAX_TOPICS = 8
+BATCH_MAX_OPINIONS = 256
+# Near-duplicate collapsing: opinions with the same normalized text or embeddings at least this
+# similar are clustered through one representative
+DEDUPE_SIMILARITY = float(os.getenv("CLUSTERING_DEDUPE_SIMILARITY", "0.97"))
+DEDUPE_BLOCK = 1024 # rows per similarity block, bounds memory to DEDUPE_BLOCK x unique texts
+# How cluster leaders are picked: softmax, multiplicity or top_weight, see pick_leaders()
+LEADER_STRATEGY = os.getenv("CLUSTERING_LEADER_STRATEGY", "softmax")
+# Scheduling
+MAX_BACKLOG = int(os.getenv("CLUSTERING_MAX_BACKLOG", "32")) # waiting jobs before triggers are rejected
+MAX_TOPIC_SHARE = float(os.getenv("CLUSTERING_MAX_TOPIC_SHARE", "0.5")) # share of recent worker time per topic
+SHARE_WINDOW = 60 # seconds of worker time considered for MAX_TOPIC_SHARE
+# Supervision
+TASK_TIMEOUT = float(os.getenv("CLUSTERING_TASK_TIMEOUT", "300")) # wall-clock seconds before a task is killed
+SUPERVISE_INTERVAL = 1.0
+RESTART_BACKOFF_MAX = 60.0 # seconds between restarts of a process that keeps dying before it is ready
+READY_TIMEOUT = float(os.getenv("CLUSTERING_READY_TIMEOUT", "300")) # seconds app.py waits for the workers at startup
+# Workers are started from a clean process instead of forked from the parent, whose Flask, ingest
+# and collector threads may hold locks a forked child would inherit in the locked state
+START_METHOD = os.getenv("CLUSTERING_START_METHOD", "forkserver")
+EMBED_BATCH_SIZE = 32
+EMBED_BATCH_WAIT = 0.05 # seconds to wait for more submissions before encoding a batch
+
+_mp = None # multiprocessing context for START_METHOD
 _worker_pool = None
-_task_queue = None
+_task_queues = None # one per worker slot, so the parent knows which worker owns a task from the moment it is sent
+# worker -> parent: ("ready", pid, timings), ("start", pid, [(topic_uuid, job_id)]),
+# ("done", pid, topic_uuid, seconds, status, advanced) where advanced tells whether the topic went live
+_event_queue = None
+_embed_process = None
+_embed_queue = None
+_embed_backlog = None # opinions submitted but not yet embedded
+_worker_startup = {} # pid -> {"load": s, "warmup": s}
+_cpu_config = None # see load_cpu_config()
+_done_listeners = [] # called with the topic_uuid after a worker reports a job done
+
+# Scheduling state, only touched in the parent process.
+# A topic is "in flight" from the moment it is scheduled until a worker reports it done, so at most
+# one clustering per topic is waiting or running at any time. Triggers that arrive while its job is
+# still waiting are folded into that job; once it is dispatched they are coalesced into _pending and
+# run once more after the current one finishes.
+# Waiting jobs sit in _ready_heap ordered earliest-deadline-first (smaller topics first on ties) and
+# are only handed to the task queue when a worker is idle, so the order is decided as late as possible.
+_schedule_lock = threading.Lock()
+_in_flight = set()
+_pending = {} # topic_uuid -> full
+_coalesced_triggers = 0
+_ready_heap = [] # (demoted, deadline, size, seq, topic_uuid, full, job_id)
+_sequence = itertools.count()
+_recent_runs = [] # (finished_at, topic_uuid, seconds) within SHARE_WINDOW
+# slot -> {"pid": worker pid, "jobs": {topic_uuid: job_id}, "started_at": t or None until the worker reports it}.
+# A slot is busy from dispatch until its last job is done, so a worker that dies before it even
+# reports the start still has its jobs failed by the supervisor.
+_running = {}
+_restarts = 0
+# Crash-loop backoff: slot (or "embedder") -> {"failures": n, "restart_at": t}. A dead worker's slot
+# stays out of dispatch until it is restarted.
+_down = {}
+_embed_started_at = 0.0
+
+
+class BacklogFull(Exception):
+    """Raised by trigger() when too many clustering jobs are waiting"""
+    def __init__(self, retry_after):
+        super().__init__(f"Clustering backlog full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class TopicNotFound(Exception):
+    """Raised by trigger() for a topic that does not exist"""
+
+# Per-process model registry. Every worker fills it once at startup so that
+# tasks only pay for inference, never for loading the weights again.
+_models = {}
+
+def get_model(name=EMBEDDING_MODEL, backend=None):
+    backend = backend or EMBEDDING_BACKEND
+    if (name, backend) not in _models:
+        _models[(name, backend)] = load_model(name, backend)
+    return _models[(name, backend)]
+
+def load_model(name, backend):
+    if backend == "onnx":
+        return SentenceTransformer(export_onnx(name), backend="onnx", trust_remote_code=True)
+
+    model = SentenceTransformer(name, trust_remote_code=True, cache_folder=MODEL_CACHE_DIR)
+    if backend == "torch-int8":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+def export_onnx(name) -> str:
+    """
+    Export the ONNX graph of a model to MODEL_CACHE_DIR unless it is already there and return its directory.
+    init() calls this before starting any process, so the workers only ever load a finished export.
+    """
+    onnx_dir = os.path.join(MODEL_CACHE_DIR, "onnx", name.replace("/", "__"))
+    if os.path.isfile(os.path.join(onnx_dir, ONNX_MODEL_FILE)):
+        return onnx_dir
+    model = SentenceTransformer(name, backend="onnx", trust_remote_code=True, cache_folder=MODEL_CACHE_DIR)
+    # Saved next to the final directory and renamed into place, so nobody can load half a model
+    tmp_dir = f"{onnx_dir}.{os.getpid()}.tmp"
+    model.save(tmp_dir)
+    if os.path.isdir(onnx_dir):
+        # Left behind by an interrupted export that wrote in place
+        shutil.rmtree(onnx_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, onnx_dir)
+    except OSError:
+        # Another process finished its export first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return onnx_dir
+
+def embedding_cache_key(name=EMBEDDING_MODEL, backend=None):
+    """Vectors of different backends differ slightly, so they are cached separately"""
+    backend = backend or EMBEDDING_BACKEND
+    return name if backend == "torch" else f"{name}:{backend}"
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def embed_raw_opinions(raw_opinions, topic_uuid=None):
+    """Embed raw opinions, reusing vectors cached in the database and only encoding the misses"""
+    return embed_topics([(raw_opinions, topic_uuid)])[0]
+
+def embed_topics(topics):
+    """
+    Embed the opinions of several (raw_opinions, topic_uuid) pairs in one encode pass.
+    Cached vectors are reused, and one embedding matrix is returned per topic.
+    """
+    vectors = []
+    misses = [] # (topic index, opinion index)
+    for t, (raw_opinions, topic_uuid) in enumerate(topics):
+        cached = db.get_raw_opinion_embeddings(topic_uuid, embedding_cache_key()) if topic_uuid else {}
+        topic_vectors = [None] * len(raw_opinions)
+        for i, opinion in enumerate(raw_opinions):
+            hit = cached.get(opinion['raw_id'])
+            if hit and hit[0] == content_hash(opinion['opinion']):
+                topic_vectors[i] = np.frombuffer(hit[1], dtype=np.float16).astype(np.float32)
+            else:
+                misses.append((t, i))
+        vectors.append(topic_vectors)
+
+    if misses:
+        # encode() sorts its input by length before batching, so a single call over all topics
+        # keeps padding low even when the topics themselves are tiny
+        texts = [topics[t][0][i]['opinion'] for t, i in misses]
+        encoded = get_model().encode([f"clustering: {text}" for text in texts])
+        rows = []
+        for (t, i), vector in zip(misses, encoded):
+            opinion = topics[t][0][i]
+            vectors[t][i] = np.asarray(vector, dtype=np.float32)
+            if topics[t][1]:
+                rows.append((opinion['raw_id'], content_hash(opinion['opinion']), vectors[t][i].astype(np.float16).tobytes()))
+        if rows:
+            db.insert_raw_opinion_embeddings(rows, embedding_cache_key())
+
+    total = sum(len(raw_opinions) for raw_opinions, _ in topics)
+    print(f"Embeddings for {len(topics)} topics: {total - len(misses)} cached, {len(misses)} encoded")
+    return [np.vstack(topic_vectors) if topic_vectors else np.empty((0, 0), dtype=np.float32)
+            for topic_vectors in vectors]
+
+def load_cpu_config() -> dict:
+    """
+    Read the CPU budget for the clustering processes from the environment:
+    CLUSTERING_WORKERS           number of clustering workers
+    CLUSTERING_TORCH_THREADS     torch intra-op threads per process, 0 splits the cores evenly
+                                 between the workers and the embedding process
+    CLUSTERING_CPU_AFFINITY      "true" pins every process to its own slice of cores
+    CLUSTERING_PARTITION_JOBS    partitions of a very large topic one worker clusters in parallel, in
+                                 extra processes on top of its torch threads (see PARTITION_JOBS)
+    """
+    cpu_count = os.cpu_count() or 1
+    workers = int(os.getenv("CLUSTERING_WORKERS", str(NUM_WORKERS)))
+    torch_threads = int(os.getenv("CLUSTERING_TORCH_THREADS", "0")) or max(1, cpu_count // (workers + 1))
+    affinity = os.getenv("CLUSTERING_CPU_AFFINITY", "false").lower() == "true"
+    return {"workers": workers, "torch_threads": torch_threads, "affinity": affinity, "partition_jobs": PARTITION_JOBS}
+
+def cpus_for_slot(slot, torch_threads):
+    """Cores assigned to the process in the given slot when CPU affinity is enabled"""
+    cpu_count = os.cpu_count() or 1
+    return {(slot * torch_threads + i) % cpu_count for i in range(torch_threads)}
+
+def configure_process(torch_threads, cpus=None):
+    torch.set_num_threads(torch_threads)
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+
+def check_backend(backend) -> str:
+    """Return the embedding backend to use: unknown names are an error, onnx without its runtime falls back to torch"""
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown CLUSTERING_EMBEDDING_BACKEND {backend!r}, expected one of {EMBEDDING_BACKENDS}")
+    if backend == "onnx" and importlib.util.find_spec("optimum") is None:
+        print("Embedding backend onnx needs optimum[onnxruntime], which is not installed; falling back to torch")
+        return "torch"
+    return backend
+
+def l2_normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+def reduce_embeddings(embeddings, method=REDUCTION_METHOD, dim=REDUCTION_DIM):
+    """
+    Project embeddings onto dim dimensions and L2-normalize them again, so euclidean distance
+    on the result orders pairs like cosine distance on the full vectors.
+    """
+    normalized = l2_normalize(embeddings)
+    if method == "truncate":
+        reduced = normalized[:, :dim]
+    else:
+        reduced = PCA(n_components=min(dim, *normalized.shape), random_state=0).fit_transform(normalized)
+    return l2_normalize(reduced)
 
 def init():
-    global _worker_pool, _task_queue
-    _task_queue = multiprocessing.Queue()
-    _worker_pool = []
-    for i in range(4):
-        p = multiprocessing.Process(target=worker_process, args=(_task_queue,))
-        p.start()
-        _worker_pool.append(p)
-
-def trigger(topic_uuid):
-    assert _task_queue is not None, "Worker pool not initialized"
+    global _mp, _worker_pool, _task_queues, _event_queue, _embed_process, _embed_backlog, _cpu_config
+    global EMBEDDING_BACKEND
+    # Checked once here, the processes get the result passed in instead of each crashing on a bad backend
+    EMBEDDING_BACKEND = check_backend(EMBEDDING_BACKEND)
+    if EMBEDDING_BACKEND == "onnx":
+        export_onnx(EMBEDDING_MODEL)
+    _cpu_config = load_cpu_config()
+    print(f"Clustering CPU budget: {_cpu_config}, embedding backend {EMBEDDING_BACKEND}")
+    _mp = multiprocessing.get_context(START_METHOD)
+    _event_queue = _mp.Queue()
+    _task_queues = [None] * _cpu_config["workers"]
+    _worker_pool = [_start_worker(slot) for slot in range(_cpu_config["workers"])]
+
+    _embed_backlog = _mp.Value('i', 0)
+    _embed_process = _start_embedder()
+    threading.Thread(target=_collect_events, args=(_event_queue,), daemon=True).start()
+    threading.Thread(target=_supervise, daemon=True).start()
+
+def _slot_settings(slot):
+    threads = _cpu_config["torch_threads"]
+    return threads, cpus_for_slot(slot, threads) if _cpu_config["affinity"] else None
+
+def _start_worker(slot):
+    # A fresh queue, tasks left in a dead worker's queue were already failed with it
+    _task_queues[slot] = _mp.Queue()
+    p = _mp.Process(target=worker_process, args=(_task_queues[slot], _event_queue, *_slot_settings(slot)),
+                    kwargs={"backend": EMBEDDING_BACKEND})
+    p.start()
+    return p
+
+def _start_embedder():
+    global _embed_started_at, _embed_queue
+    _embed_started_at = time.time()
+    # A fresh queue like for the workers, a process killed while reading can leave the old one locked.
+    # Opinions still in it or taken off it are encoded when their topic is clustered, so the backlog
+    # starts over.
+    with _embed_backlog.get_lock():
+        if _embed_queue is not None:
+            _embed_queue.cancel_join_thread()
+            _embed_queue.close()
+        _embed_queue = _mp.Queue()
+        _embed_backlog.value = 0
+    # The embedding process takes the slot after the last worker
+    p = _mp.Process(target=embedding_process,
+                    args=(_embed_queue, _embed_backlog, *_slot_settings(len(_worker_pool))),
+                    kwargs={"backend": EMBEDDING_BACKEND})
+    p.start()
+    return p
+
+def _supervise():
+    """Restart dead workers and kill workers whose task exceeds TASK_TIMEOUT"""
+    while True:
+        time.sleep(SUPERVISE_INTERVAL)
+        try:
+            _supervise_once()
+        except Exception as e:
+            # A locked database or a failed fork must not end supervision, the next pass tries again
+            print(f"Supervision pass failed: {e}")
+
+def _supervise_once():
+    global _embed_process, _restarts
+    for i, p in enumerate(_worker_pool):
+        if i in _down:
+            restart_at = _down[i]["restart_at"]
+            if restart_at == math.inf and not p.is_alive():
+                print(f"Worker {p.pid} died with exit code {p.exitcode} before it was ready")
+                _take_down(i, crashed=True)
+            elif time.time() >= restart_at:
+                _worker_pool[i] = _start_worker(i)
+                _restarts += 1
+                with _schedule_lock:
+                    _down[i]["restart_at"] = math.inf # failures are kept until the worker is ready
+                    _pump()
+            continue
+        with _schedule_lock:
+            task = _running.get(i)
+            started_at = task["started_at"] if task else None
+        if started_at is not None and time.time() - started_at > TASK_TIMEOUT:
+            print(f"Worker {p.pid} exceeded {TASK_TIMEOUT}s on topics {list(task['jobs'])}, terminating")
+            p.terminate()
+            p.join()
+            _take_down(i, crashed=False)
+            _abort_task(i, f"timeout after {TASK_TIMEOUT}s")
+        elif not p.is_alive():
+            print(f"Worker {p.pid} died with exit code {p.exitcode}")
+            # A worker that never got ready (bad backend, missing model) would crash again right away
+            _take_down(i, crashed=p.pid not in _worker_startup)
+            _abort_task(i, f"worker died with exit code {p.exitcode}")
+
+    embedder = _down.get("embedder")
+    if embedder is None or embedder["restart_at"] == math.inf:
+        if not _embed_process.is_alive():
+            print(f"Embedding process died with exit code {_embed_process.exitcode}")
+            # It reports no readiness, so dying soon after its start counts as a crash
+            _take_down("embedder", crashed=time.time() - _embed_started_at < RESTART_BACKOFF_MAX)
+        elif embedder is not None and time.time() - _embed_started_at >= RESTART_BACKOFF_MAX:
+            del _down["embedder"]
+    elif time.time() >= embedder["restart_at"]:
+        _embed_process = _start_embedder()
+        _restarts += 1
+        embedder["restart_at"] = math.inf
+
+def _take_down(key, crashed):
+    """Keep a dead process down, for longer the more often it crashed in a row"""
+    with _schedule_lock:
+        failures = _down.get(key, {}).get("failures", 0) + 1 if crashed else 0
+        delay = min(RESTART_BACKOFF_MAX, SUPERVISE_INTERVAL * 2 ** failures) if failures else 0
+        _down[key] = {"failures": failures, "restart_at": time.time() + delay}
+    if delay:
+        print(f"Restarting {key} in {delay:.0f}s after {failures} crashes in a row")
+
+def _abort_task(slot, error):
+    with _schedule_lock:
+        task = _running.get(slot)
+        jobs = dict(task["jobs"]) if task else {}
+        pid = task["pid"] if task else None
+        started_at = (task["started_at"] if task else None) or time.time()
+    for topic_uuid, job_id in jobs.items():
+        try:
+            db.finish_clustering_job(job_id, "failed", time.time(), error=error)
+        except Exception as e:
+            # The slot is released regardless, the worker is already down and will not retry
+            print(f"Could not mark job {job_id} of {topic_uuid} failed: {e}")
+        if _finish(pid, topic_uuid, time.time() - started_at):
+            _notify_done(topic_uuid, "failed", False)
+
+def add_done_listener(listener):
+    """
+    Call listener(topic_uuid) in the parent whenever a job ends, successful or not, including jobs
+    failed by the supervisor. The latest ClusteringJob row of the topic tells which.
+    """
+    _done_listeners.append(listener)
+
+def _collect_events(event_queue):
+    while True:
+        event = event_queue.get()
+        try:
+            _handle_event(event)
+        except Exception as e:
+            # This thread is the only consumer of worker events, it must survive a failing handler
+            print(f"Failed to handle worker event {event[:3]}: {e}")
+
+def _handle_event(event):
+    if event[0] == "ready":
+        _, pid, timings = event
+        _worker_startup[pid] = timings
+        with _schedule_lock:
+            slot = next((i for i, p in enumerate(_worker_pool) if p.pid == pid), None)
+            if _down.get(slot, {}).get("restart_at") == math.inf:
+                # Restarted and healthy again
+                del _down[slot]
+                _pump()
+        print(f"Worker {pid} ready: model load {timings['load']:.2f}s, warmup {timings['warmup']:.2f}s")
+    elif event[0] == "start":
+        pid = event[1]
+        with _schedule_lock:
+            slot = _slot_of(pid)
+            if slot is not None:
+                _running[slot]["started_at"] = time.time()
+    elif event[0] == "done":
+        _, pid, topic_uuid, seconds, status, advanced = event
+        if _finish(pid, topic_uuid, seconds):
+            _notify_done(topic_uuid, status, advanced)
+
+def _notify_done(topic_uuid, status, advanced):
+    if advanced:
+        # The worker moved the topic from loading to live in its own process
+        db.invalidate_topic(topic_uuid)
+    try:
+        events.publish(topic_uuid, "clustered", {"status": status})
+        if advanced:
+            events.publish_topic_state(topic_uuid)
+    except Exception as e:
+        print(f"Could not publish the clustering of {topic_uuid}: {e}")
+    for listener in _done_listeners:
+        try:
+            listener(topic_uuid)
+        except Exception as e:
+            print(f"Clustering listener failed for {topic_uuid}: {e}")
+
+def _finish(pid, topic_uuid, seconds) -> bool:
+    """Release the worker's job for topic_uuid. Returns False if the supervisor already aborted it."""
+    with _schedule_lock:
+        slot = _slot_of(pid)
+        if slot is None or topic_uuid not in _running[slot]["jobs"]:
+            return False
+        task = _running[slot]
+        del task["jobs"][topic_uuid]
+        if not task["jobs"]:
+            # The worker finished its whole batch and is idle again
+            del _running[slot]
+        now = time.time()
+        _recent_runs.append((now, topic_uuid, seconds))
+        while _recent_runs and _recent_runs[0][0] < now - SHARE_WINDOW:
+            _recent_runs.pop(0)
+
+        if topic_uuid in _pending:
+            # New triggers arrived while this topic was running, run it once more
+            try:
+                _schedule(topic_uuid, _pending.pop(topic_uuid))
+            except Exception as e:
+                print(f"Could not schedule the rerun of {topic_uuid}: {e}")
+                _in_flight.discard(topic_uuid)
+        else:
+            _in_flight.discard(topic_uuid)
+        _pump()
+    return True
+
+def _slot_of(pid):
+    """Slot whose running jobs belong to the worker with this pid. Call with _schedule_lock held."""
+    return next((slot for slot, task in _running.items() if task["pid"] == pid), None)
+
+def ready_workers() -> int:
+    return sum(1 for p in _worker_pool or [] if p.pid in _worker_startup and p.is_alive())
+
+def wait_until_ready(timeout=None) -> bool:
+    """Block until every worker has loaded and warmed up its model"""
+    deadline = None if timeout is None else time.time() + timeout
+    while ready_workers() < len(_worker_pool or []):
+        if deadline is not None and time.time() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+def trigger(topic_uuid, full=False):
+    """
+    Queue clustering for a topic. Unless full is set, late opinions are assigned to the existing clusters.
+    Raises BacklogFull if MAX_BACKLOG jobs are already waiting for a worker and TopicNotFound
+    for an unknown topic.
+    """
+    assert _task_queues is not None, "Worker pool not initialized"
     assert _worker_pool is not None, "Worker pool not initialized"
-    _task_queue.put(topic_uuid)
+    global _coalesced_triggers
+    with _schedule_lock:
+        if topic_uuid in _in_flight:
+            _coalesced_triggers += 1
+            waiting = next((i for i, entry in enumerate(_ready_heap) if entry[4] == topic_uuid), None)
+            if waiting is not None:
+                # Not dispatched yet, so the job will read the newest opinions anyway. Only upgrade it
+                # to a full recluster if asked; the sort key does not include full, the heap stays valid.
+                if full:
+                    _ready_heap[waiting] = _ready_heap[waiting][:5] + (True,) + _ready_heap[waiting][6:]
+                return
+            # Latest wins, but a requested full recluster is never downgraded
+            _pending[topic_uuid] = _pending.get(topic_uuid, False) or full
+            return
+        if len(_ready_heap) >= MAX_BACKLOG:
+            raise BacklogFull(_estimate_retry_after())
+        # Only mark the topic in flight once its job exists, so a failed insert cannot leave it stuck
+        _schedule(topic_uuid, full)
+        _in_flight.add(topic_uuid)
+        _pump()
+
+def _schedule(topic_uuid, full):
+    topic = db.get_content_by_uuid(topic_uuid)
+    if topic is None:
+        raise TopicNotFound(topic_uuid)
+    deadline = topic[2] if topic[2] is not None else math.inf
+    size = db.count_raw_opinions_for_topic(topic_uuid)
+    demoted = _topic_share(topic_uuid) > MAX_TOPIC_SHARE
+    job_id = db.insert_clustering_job(topic_uuid, time.time())
+    heapq.heappush(_ready_heap, (demoted, deadline, size, next(_sequence), topic_uuid, full, job_id))
 
-def worker_process(task_queue):
+def _pump():
+    """Hand the most urgent waiting jobs to idle workers"""
+    idle = [slot for slot in range(len(_worker_pool)) if slot not in _running and slot not in _down]
+    while _ready_heap and idle:
+        # Spread the waiting jobs over the idle workers, batching only when there are more jobs than workers
+        batch_size = min(BATCH_MAX_TOPICS, math.ceil(len(_ready_heap) / len(idle)))
+        entry = heapq.heappop(_ready_heap)
+        batch = [entry]
+        opinions = entry[2]
+        while _ready_heap and len(batch) < batch_size and opinions + _ready_heap[0][2] <= BATCH_MAX_OPINIONS:
+            entry = heapq.heappop(_ready_heap)
+            batch.append(entry)
+            opinions += entry[2]
+        slot = idle.pop(0)
+        _running[slot] = {"pid": _worker_pool[slot].pid, "started_at": None,
+                          "jobs": {topic_uuid: job_id for _, _, _, _, topic_uuid, _, job_id in batch}}
+        _task_queues[slot].put([(topic_uuid, full, job_id) for _, _, _, _, topic_uuid, full, job_id in batch])
+
+def _topic_share(topic_uuid) -> float:
+    """Fraction of the pool's capacity over the last SHARE_WINDOW seconds spent on this topic"""
+    used = sum(seconds for _, topic, seconds in _recent_runs if topic == topic_uuid)
+    return used / (SHARE_WINDOW * len(_worker_pool))
+
+def _estimate_retry_after() -> int:
+    if _recent_runs:
+        average = sum(seconds for _, _, seconds in _recent_runs) / len(_recent_runs)
+    else:
+        average = 1.0
+    return max(1, math.ceil(average * len(_ready_heap) / len(_worker_pool)))
+
+def queue_stats() -> dict:
+    with _schedule_lock:
+        return {
+            "in_flight": len(_in_flight),
+            "waiting": len(_ready_heap),
+            "busy_workers": len(_running),
+            "pending_reruns": len(_pending),
+            "coalesced_triggers": _coalesced_triggers
+        }
+
+def pool_stats() -> dict:
+    """Worker health and utilization over the last SHARE_WINDOW seconds"""
+    with _schedule_lock:
+        now = time.time()
+        busy_seconds = sum(seconds for _, _, seconds in _recent_runs)
+        busy_seconds += sum(min(now - task["started_at"], SHARE_WINDOW)
+                            for task in _running.values() if task["started_at"] is not None)
+        return {
+            "workers": len(_worker_pool),
+            "alive": sum(1 for p in _worker_pool if p.is_alive()),
+            "ready": ready_workers(),
+            "running": sum(len(task["jobs"]) for task in _running.values()),
+            "utilization": min(1.0, busy_seconds / (SHARE_WINDOW * len(_worker_pool))),
+            "restarts": _restarts,
+            "down": sorted(str(key) for key in _down),
+            "cpu_config": _cpu_config
+        }
+
+def enqueue_embedding(raw_id, opinion):
+    """Hand a freshly submitted opinion to the background embedding stage"""
+    if _embed_queue is None:
+        return
+    # Under the lock, so a restart of the embedding process cannot swap the queue in between
+    with _embed_backlog.get_lock():
+        _embed_backlog.value += 1
+        _embed_queue.put((raw_id, opinion))
+
+def embedding_backlog() -> int:
+    return _embed_backlog.value if _embed_backlog is not None else 0
+
+def embedding_process(embed_queue, backlog, torch_threads=None, cpus=None, backend=None):
+    if torch_threads:
+        configure_process(torch_threads, cpus)
+    use_backend(backend)
+    warmup_worker()
     while True:
-        topic_uuid = task_queue.get()
-        if topic_uuid is None:
+        item = embed_queue.get()
+        if item is None:
             break
+        batch = [item]
         try:
-            opinions = db.get_raw_opinions_for_topic(topic_uuid)
-            print(f"Worker processing {len(opinions)} opinions for topic: {topic_uuid}")
+            while len(batch) < EMBED_BATCH_SIZE:
+                item = embed_queue.get(timeout=EMBED_BATCH_WAIT)
+                if item is None:
+                    break
+                batch.append(item)
+        except queue.Empty:
+            pass
 
-            clusters = cluster_raw_opinions(opinions)
-            print(f"Generated {len(clusters)} clusters")
+        try:
+            encoded = get_model().encode([f"clustering: {opinion}" for _, opinion in batch])
+            db.insert_raw_opinion_embeddings([
+                (raw_id, content_hash(opinion), np.asarray(vector, dtype=np.float16).tobytes())
+                for (raw_id, opinion), vector in zip(batch, encoded)
+            ], embedding_cache_key())
+        except Exception as e:
+            # Misses are encoded again when the topic gets clustered
+            print(f"Embedding error for batch of {len(batch)} opinions: {e}")
+        finally:
+            with backlog.get_lock():
+                backlog.value -= len(batch)
 
-            winners = pick_random_winners(clusters)
-            print(f"Selected {len(winners)} cluster leaders")
+        if item is None:
+            break
 
-            clusters_data = [{
-                'heading': winner_data['winner']['opinion'],
-                'leader_id': winner_data['username'],
-                'raw_opinions': winner_data['cluster']
-            } for winner_data in winners]
+def warmup_worker():
+    """Load the embedding model and run one encode so the first task is not slowed down by lazy init"""
+    start = time.perf_counter()
+    model = get_model()
+    loaded = time.perf_counter()
+    model.encode(["clustering: warmup"])
+    warm = time.perf_counter()
+    return {"load": loaded - start, "warmup": warm - loaded}
 
-            cluster_ids = db.replace_clusters_for_topic(clusters_data, topic_uuid)
+def use_backend(backend):
+    """Use the backend the parent checked, a spawned process would otherwise read the environment again"""
+    global EMBEDDING_BACKEND
+    if backend:
+        EMBEDDING_BACKEND = backend
 
-            for i, cluster_id in enumerate(cluster_ids):
-                print(f"Created cluster {cluster_id} with leader {clusters_data[i]['leader_id']} and {len(clusters_data[i]['raw_opinions'])} opinions")
+def worker_process(task_queue, event_queue=None, torch_threads=None, cpus=None, backend=None):
+    if torch_threads:
+        configure_process(torch_threads, cpus)
+    use_backend(backend)
+    startup = warmup_worker()
+    if event_queue is not None:
+        event_queue.put(("ready", multiprocessing.current_process().pid, startup))
 
-        except Exception as e:
-            print(f"Worker error processing {topic_uuid}: {e}")
-            # TODO: Mark task as failed in database
+    while True:
+        tasks = task_queue.get()
+        if tasks is None:
+            break
+        pid = multiprocessing.current_process().pid
+        if event_queue is not None:
+            event_queue.put(("start", pid, [(topic_uuid, job_id) for topic_uuid, _, job_id in tasks]))
+        for _, _, job_id in tasks:
+            db.start_clustering_job(job_id, time.time())
+
+        prefetched = {}
+        if len(tasks) > 1:
+            try:
+                prefetched = prefetch_topics([topic_uuid for topic_uuid, _, _ in tasks])
+            except Exception as e:
+                # Fall back to fetching and embedding every topic on its own
+                print(f"Worker error prefetching batch of {len(tasks)} topics: {e}")
+
+        for topic_uuid, full, job_id in tasks:
+            _run_job(topic_uuid, full, job_id, prefetched.get(topic_uuid, {}), event_queue, pid)
+
+def _run_job(topic_uuid, full, job_id, prefetched, event_queue, pid):
+    started = time.perf_counter()
+    status, advanced = "failed", False
+    try:
+        mode, opinion_count, changes, timings = process_topic(topic_uuid, full, **prefetched)
+        # A topic waiting for its clustering after the deadline goes live now
+        advanced = db.advance_topic_state(topic_uuid, 1, 2)
+        db.finish_clustering_job(job_id, "done", time.time(), mode=mode, opinion_count=opinion_count,
+                                 timings=json.dumps(timings), changes=changes)
+        status = "done"
+    except Exception as e:
+        print(f"Worker error processing {topic_uuid}: {e}")
+        db.finish_clustering_job(job_id, "failed", time.time(), error=str(e))
+    finally:
+        if event_queue is not None:
+            event_queue.put(("done", pid, topic_uuid, time.perf_counter() - started, status, advanced))
+
+def prefetch_topics(topic_uuids):
+    """Fetch the opinions of a batch of topics and embed all of them in a single encode pass"""
+    start = time.perf_counter()
+    opinions = [db.get_raw_opinions_for_topic(topic_uuid) for topic_uuid in topic_uuids]
+    fetched = time.perf_counter()
+    embeddings = embed_topics(list(zip(opinions, topic_uuids)))
+    embedded = time.perf_counter()
+    return {topic_uuid: {
+        "opinions": opinions[i],
+        "embeddings": embeddings[i],
+        # Batch-wide stage times, shared by every topic of the batch
+        "timings": {"batch_fetch": fetched - start, "batch_embed": embedded - fetched}
+    } for i, topic_uuid in enumerate(topic_uuids)}
+
+def process_topic(topic_uuid, full=False, opinions=None, embeddings=None, timings=None):
+    """
+    Cluster one topic. Returns (mode, opinion_count, changes, timings) where changes counts the
+    assigned opinions or rewritten rows and timings maps stage -> seconds.
+    opinions and embeddings can be passed in when they were already fetched for a batch of topics.
+    """
+    if timings is None:
+        timings = {}
+    if opinions is None:
+        start = time.perf_counter()
+        opinions = db.get_raw_opinions_for_topic(topic_uuid)
+        timings['fetch'] = time.perf_counter() - start
+    print(f"Worker processing {len(opinions)} opinions for topic: {topic_uuid}")
+
+    assignments = None if full else assign_incrementally(opinions, topic_uuid, timings, embeddings)
+    if assignments is not None:
+        start = time.perf_counter()
+        db.assign_raw_opinions_to_clusters(assignments)
+        timings['persist'] = time.perf_counter() - start
+        print(f"Assigned {len(assignments)} new opinions to existing clusters")
+        mode = "incremental"
+        changes = len(assignments)
+    else:
+        labels, multiplicity = cluster_labels(opinions, timings, topic_uuid=topic_uuid, embeddings=embeddings)
+        members = group_by_label(labels)
+        print(f"Generated {len(members)} clusters")
+
+        start = time.perf_counter()
+        leaders = pick_leaders(labels, [opinion['weight'] for opinion in opinions], topic_rng(topic_uuid),
+                               multiplicity=multiplicity)
+        print(f"Selected {len(leaders)} cluster leaders")
+
+        clusters_data = [{
+            'heading': opinions[leader]['opinion'],
+            'leader_id': opinions[leader]['username'],
+            'raw_opinions': [opinions[i] for i in members[label]]
+        } for label, leader in leaders.items()]
+
+        cluster_ids, rows_written = db.replace_clusters_for_topic(clusters_data, topic_uuid)
+        timings['persist'] = time.perf_counter() - start
+
+        for i, cluster_id in enumerate(cluster_ids):
+            print(f"Wrote cluster {cluster_id} with {len(clusters_data[i]['raw_opinions'])} opinions")
+        print(f"Persisted {len(cluster_ids)} clusters with {rows_written} rows written")
+        mode = "full"
+        changes = rows_written
+
+    print(f"Timings for {topic_uuid}: " + ", ".join(f"{stage} {seconds * 1000:.1f}ms" for stage, seconds in timings.items()))
+    return mode, len(opinions), changes, timings
+
+def assign_incrementally(raw_opinions, topic_uuid, timings=None, embeddings=None):
+    """
+    Assign opinions that arrived after the last clustering to the nearest existing cluster centroid.
+    Returns a list of (cluster_id, raw_id) assignments, or None if a full recluster is needed
+    because there are no clusters yet or the new opinions drift too far from the existing ones.
+    Opinions below the similarity threshold stay unassigned and count towards the next drift check.
+    """
+    if timings is None:
+        timings = {}
+    old_idx = [i for i, o in enumerate(raw_opinions) if o['clustered_opinion_id'] is not None]
+    new_idx = [i for i, o in enumerate(raw_opinions) if o['clustered_opinion_id'] is None]
+    if not old_idx:
+        return None
+    if not new_idx:
+        return []
+    if len(new_idx) > INCREMENTAL_MAX_GROWTH * len(old_idx):
+        print(f"Incremental assignment skipped: {len(new_idx)} new vs {len(old_idx)} clustered opinions")
+        return None
+
+    if embeddings is None:
+        start = time.perf_counter()
+        embeddings = embed_raw_opinions(raw_opinions, topic_uuid)
+        timings['embed'] = time.perf_counter() - start
 
-def cluster_raw_opinions(raw_opinions):
+    start = time.perf_counter()
+    normalized = l2_normalize(embeddings)
+    cluster_ids, members = np.unique([raw_opinions[i]['clustered_opinion_id'] for i in old_idx], return_inverse=True)
+    centroids = np.zeros((len(cluster_ids), normalized.shape[1]), dtype=normalized.dtype)
+    np.add.at(centroids, members, normalized[old_idx])
+    centroids = l2_normalize(centroids)
+
+    similarities = normalized[new_idx] @ centroids.T
+    nearest = similarities.argmax(axis=1)
+    matched = similarities[np.arange(len(new_idx)), nearest] >= INCREMENTAL_MIN_SIMILARITY
+    timings['assign'] = time.perf_counter() - start
+
+    misses = len(new_idx) - int(matched.sum())
+    if misses > INCREMENTAL_MAX_NOISE * len(new_idx):
+        print(f"Incremental assignment skipped: {misses} of {len(new_idx)} new opinions match no cluster")
+        return None
+
+    return [(int(cluster_ids[nearest[j]]), raw_opinions[i]['raw_id'])
+            for j, i in enumerate(new_idx) if matched[j]]
+
+def cluster_raw_opinions(raw_opinions, timings=None, topic_uuid=None, embeddings=None):
+    """Cluster raw opinions and return them as a list of clusters"""
+    labels, _ = cluster_labels(raw_opinions, timings, topic_uuid, embeddings)
+    return [[raw_opinions[i] for i in members] for members in group_by_label(labels).values()]
+
+def cluster_labels(raw_opinions, timings=None, topic_uuid=None, embeddings=None):
+    """
+    Cluster raw opinions. Returns (labels, multiplicity): the cluster label of every opinion and
+    how many opinions of the topic are near-duplicates of it (itself included).
+    """
+    if timings is None:
+        timings = {}
     if len(raw_opinions) < 2:
-        return [raw_opinions] if raw_opinions else []
+        return np.zeros(len(raw_opinions), dtype=int), np.ones(len(raw_opinions), dtype=int)
+
+    if embeddings is None:
+        start = time.perf_counter()
+        embeddings = embed_raw_opinions(raw_opinions, topic_uuid)
+        timings['embed'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    representatives, groups = dedupe_opinions(raw_opinions, embeddings)
+    vectors = embeddings[representatives]
+    timings['dedupe'] = time.perf_counter() - start
+    print(f"Collapsed {len(raw_opinions)} opinions into {len(representatives)} representatives")
+
+    metric = "cosine"
+    if REDUCTION_METHOD != "none" and len(vectors) >= REDUCTION_MIN_OPINIONS:
+        start = time.perf_counter()
+        vectors = reduce_embeddings(vectors)
+        # Unit vectors: euclidean keeps the cosine ordering and lets HDBSCAN use a space-partitioning tree
+        metric = "euclidean"
+        timings['reduce'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if len(vectors) >= PARTITION_MIN_OPINIONS:
+        representative_labels = partitioned_labels(vectors, metric)
+    else:
+        representative_labels = hdbscan_labels(vectors, metric)
+    labels = fan_out_labels(representative_labels, groups)
+    timings['cluster'] = time.perf_counter() - start
+
+    return labels, np.bincount(groups)[groups]
+
+def normalize_text(text):
+    return " ".join(re.sub(r"[^\w\s]", "", text.lower()).split())
+
+def dedupe_opinions(raw_opinions, embeddings, threshold=DEDUPE_SIMILARITY):
+    """
+    Group opinions that share their normalized text or whose embeddings have a cosine similarity
+    of at least threshold. Returns (representatives, groups): the opinion index standing in for
+    each group, and for every opinion the position of its group in representatives.
+    From PARTITION_MIN_OPINIONS unique texts on, embeddings are only compared within coarse k-means
+    partitions, since a full comparison at embedding width would cost more than the clustering itself.
+    """
+    texts = {}
+    text_ids = np.array([texts.setdefault(normalize_text(o['opinion']), len(texts)) for o in raw_opinions])
+    # Ids are handed out in order of first appearance, so this is the first opinion of every text
+    _, first = np.unique(text_ids, return_index=True)
+
+    unique_vectors = l2_normalize(embeddings[first])
+    if len(first) >= PARTITION_MIN_OPINIONS:
+        # Vectors this similar practically always end up in the same partition
+        n_partitions = math.ceil(len(first) / PARTITION_SIZE)
+        coarse = MiniBatchKMeans(n_clusters=n_partitions, batch_size=1024, n_init=1,
+                                 random_state=0).fit_predict(unique_vectors)
+        partitions = [np.flatnonzero(coarse == p) for p in range(n_partitions)]
+    else:
+        partitions = [np.arange(len(first))]
 
-    texts = [opinion['opinion'] for opinion in raw_opinions]
+    pairs = []
+    for members in partitions:
+        vectors = unique_vectors[members]
+        for start in range(0, len(members), DEDUPE_BLOCK):
+            rows, cols = np.nonzero(vectors[start:start + DEDUPE_BLOCK] @ vectors.T >= threshold)
+            pairs.extend((members[start + r], members[c]) for r, c in zip(rows, cols) if start + r < c)
 
-    model = SentenceTransformer('tencent/Youtu-Embedding', trust_remote_code=True, cache_folder='/state')
-    embeddings = model.encode([f"clustering: {text}" for text in texts])
+    roots, groups_of_texts = np.unique(connected_components(len(first), pairs), return_inverse=True)
+    return first[roots], groups_of_texts[text_ids]
 
+def fan_out_labels(representative_labels, groups):
+    """
+    Give every opinion the label of its representative. Groups with several members that came out
+    as noise become a cluster of their own, as HDBSCAN would do with the identical points.
+    """
+    labels = np.asarray(representative_labels)[groups]
+    next_label = labels.max() + 1
+    multiplicity = np.bincount(groups)
+    for group in np.flatnonzero((multiplicity > 1) & (np.asarray(representative_labels) == -1)):
+        labels[groups == group] = next_label
+        next_label += 1
+    return labels
+
+def connected_components(n, pairs):
+    """Union-find over n nodes, returns the root of every node"""
+    root = list(range(n))
+    def find(i):
+        while root[i] != i:
+            root[i] = root[root[i]]
+            i = root[i]
+        return i
+    for i, j in pairs:
+        root[find(i)] = find(j)
+    return [find(i) for i in range(n)]
+
+def hdbscan_labels(embeddings, metric="cosine"):
+    if len(embeddings) < 2:
+        return np.full(len(embeddings), -1)
     clusterer = HDBSCAN(min_samples=2, min_cluster_size=2, cluster_selection_method="leaf",
-                       allow_single_cluster=True, metric="cosine")
-    labels = clusterer.fit_predict(embeddings)
-
-    clusters = {}
-    for i, label in enumerate(labels):
-        if label not in clusters:
-            clusters[label] = []
-        clusters[label].append(raw_opinions[i])
-
-    return list(clusters.values())
-
-def pick_random_winners(clusters):
-    winners = []
-    for cluster in clusters:
-        if cluster:
-            weights = np.array([opinion['weight'] for opinion in cluster])
-
-            exp_weights = np.exp(weights)
-            probabilities = exp_weights / np.sum(exp_weights)
-            winner_idx = np.random.choice(len(cluster), p=probabilities)
-            random_winner = cluster[winner_idx]
-            username = random_winner['username']
-
-            winners.append({
-                'cluster': cluster,
-                'winner': random_winner,
-                'username': username
-            })
-    return winners
+                       allow_single_cluster=True, metric=metric)
+    return clusterer.fit_predict(embeddings)
+
+def partitioned_labels(embeddings, metric="cosine"):
+    """
+    Split the topic into coarse k-means partitions, run HDBSCAN on up to PARTITION_JOBS partitions
+    at a time and merge clusters that ended up split across partitions.
+    Noise of all partitions is collected under label -1.
+    """
+    n_partitions = math.ceil(len(embeddings) / PARTITION_SIZE)
+    coarse = MiniBatchKMeans(n_clusters=n_partitions, batch_size=1024, n_init=3,
+                             random_state=0).fit_predict(l2_normalize(embeddings))
+    partitions = [np.flatnonzero(coarse == p) for p in range(n_partitions)]
+
+    results = Parallel(n_jobs=min(n_partitions, PARTITION_JOBS))(
+        delayed(hdbscan_labels)(embeddings[members], metric) for members in partitions)
+
+    labels = np.full(len(embeddings), -1)
+    next_label = 0
+    for members, partition_labels in zip(partitions, results):
+        for label in np.unique(partition_labels[partition_labels >= 0]):
+            labels[members[partition_labels == label]] = next_label
+            next_label += 1
+    print(f"Partitioned {len(embeddings)} opinions into {n_partitions} partitions, {next_label} clusters before merge")
+    return merge_similar_clusters(embeddings, labels)
+
+def merge_similar_clusters(embeddings, labels, threshold=PARTITION_MERGE_SIMILARITY):
+    """Merge clusters whose centroids have a cosine similarity of at least threshold"""
+    clustered = labels >= 0
+    cluster_ids, members = np.unique(labels[clustered], return_inverse=True)
+    if len(cluster_ids) < 2:
+        return labels
+
+    centroids = np.zeros((len(cluster_ids), embeddings.shape[1]))
+    np.add.at(centroids, members, l2_normalize(embeddings[clustered]))
+    centroids = l2_normalize(centroids)
+
+    roots = connected_components(len(cluster_ids), np.argwhere(np.triu(centroids @ centroids.T >= threshold, 1)))
+
+    merged = labels.copy()
+    merged[clustered] = cluster_ids[np.asarray(roots)[members]]
+    return merged
+
+def topic_rng(topic_uuid):
+    """Generator seeded from the topic, so replaying a clustering picks the same leaders"""
+    return np.random.default_rng(int.from_bytes(hashlib.sha256(topic_uuid.encode('utf-8')).digest()[:8], 'big'))
+
+def pick_leaders(labels, weights, rng, strategy=LEADER_STRATEGY, multiplicity=None):
+    """
+    Pick one leader per cluster label in a single vectorized pass and return {label: opinion index}.
+    softmax draws with probability proportional to exp(weight), multiplicity to multiplicity * exp(weight)
+    and top_weight takes the highest weight with random tie-breaks. Sampling uses the Gumbel-max trick,
+    argmax(weight + Gumbel noise) within a group is a softmax sample and never evaluates exp(weight).
+    """
+    labels = np.asarray(labels)
+    weights = np.asarray(weights, dtype=float)
+    if len(labels) == 0:
+        return {}
+    if strategy == "top_weight":
+        order = np.lexsort((rng.random(len(labels)), weights, labels))
+    else:
+        keys = weights + rng.gumbel(size=len(labels))
+        if strategy == "multiplicity" and multiplicity is not None:
+            keys += np.log(multiplicity)
+        order = np.lexsort((keys, labels))
+
+    # Sorted by label and key, the last entry of every label run is its leader
+    sorted_labels = labels[order]
+    last = np.r_[sorted_labels[1:] != sorted_labels[:-1], True]
+    return dict(zip(sorted_labels[last].tolist(), order[last].tolist()))
+
+def group_by_label(labels):
+    """Return {label: opinion indices} for a labels array"""
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+    return {int(labels[members[0]]): members for members in np.split(order, boundaries) if len(members)}
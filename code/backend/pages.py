@@ -1,11 +1,15 @@
-from flask import Blueprint, request, make_response
+from flask import Blueprint, Response, request, make_response
 import uuid
 import time
+import json
 
 import database as db
+import deadlines
+import events
+import ingest
 import opinion_clustering
+import summaries
 
-from utils_llm import choose_proposed_solutions, ask_mistral
 from utils_chat import get_chat_LV_popularity
 routes = Blueprint('routes', __name__)
 
@@ -33,6 +37,19 @@ def status():
     return "Ok!"
 
 
+@routes.route('/metrics')
+def metrics():
+    return {
+        "embedding_backlog": opinion_clustering.embedding_backlog(),
+        "clustering_queue": opinion_clustering.queue_stats(),
+        "clustering_pool": opinion_clustering.pool_stats(),
+        "db_caches": db.cache_stats(),
+        "ingest": ingest.stats(),
+        "events": events.stats(),
+        "summaries": summaries.stats()
+    }
+
+
 @routes.route('/admin', methods=['POST'])
 def admin():
     # RequestBody
@@ -49,6 +66,7 @@ def admin():
 
 
     db.insert_topic(topic_uuid, topic, deadline)
+    deadlines.schedule(topic_uuid, deadline)
 
     # ResponseBody
     return {"uuid": topic_uuid, "deadline": deadline}
@@ -88,12 +106,7 @@ def validate():
 
     return {"status": "OK!"}, 200
 
-topic_state_mapper = {
-    0: "question",
-    1: "loading",
-    2: "live",
-    3: "result"
-}
+topic_state_mapper = db.TOPIC_STATES
 
 @routes.route('/topic/<uuid_param>', methods=['GET'])
 def get_topic(uuid_param):
@@ -172,8 +185,14 @@ def poll(uuid_param):
         return {"error": "opinion and rating are required"}, 400
 
     username = db.get_username_by_session_id(session_cookie)
-    # error if session_cookie does not exist
-    db.insert_raw_opinion(username, uuid_param, opinion, rating)
+    if not username:
+        return {"error": "session cookie not found in database"}, 401
+    # Checked up front (both lookups are cached) so the insert cannot fail on them
+    if not db.get_content_by_uuid(uuid_param):
+        return {"error": "Topic not found"}, 404
+
+    raw_id = ingest.submit(username, uuid_param, opinion, rating)
+    opinion_clustering.enqueue_embedding(raw_id, opinion)
     return {"message": "Poll response recorded"}
 
 
@@ -200,14 +219,64 @@ def error():
 @routes.route('/trigger_clustering/<uuid_param>', methods=['POST'])
 @rate_limit(1.0)
 def trigger_clustering(uuid_param):
-    opinion_clustering.trigger(uuid_param)
+    # ?full=true forces a complete recluster instead of assigning late opinions incrementally
+    full = request.args.get("full", "false").lower() == "true"
+    try:
+        opinion_clustering.trigger(uuid_param, full=full)
+    except opinion_clustering.TopicNotFound:
+        return {"error": "Topic not found"}, 404
+    except opinion_clustering.BacklogFull as e:
+        resp = make_response({"error": "Clustering backlog full", "retry_after": e.retry_after}, 503)
+        resp.headers['Retry-After'] = str(e.retry_after)
+        return resp
     return {"status": "success", "cooldown": 1.0}
 
-cluster_processed = {}
-cluster_circle_sizes = {} # A dict with the names
+@routes.route('/events/<uuid_param>', methods=['GET'])
+def topic_events(uuid_param):
+    """
+    Server-Sent Events stream for a topic, replacing the polling of /topic, /clusters,
+    /get_circle_sizes and /chat/last. Starts with a snapshot of the current state, then sends
+    topic (state changed), clustered (a clustering job finished, with its status), clusters,
+    circle_sizes and chat events.
+    """
+    result = db.get_content_by_uuid(uuid_param)
+    if not result:
+        return {"error": "Topic not found"}, 404
+
+    subscriber = events.subscribe(uuid_param)
+    initial = [events.format_event("topic", events.topic_event(result))]
+    if uuid_param in cluster_processed:
+        initial.append(events.format_event("clusters", cluster_processed[uuid_param]))
+    else:
+        # The solutions arrive as a clusters event once generated
+        summaries.generate(uuid_param)
+    if uuid_param in cluster_circle_sizes:
+        initial.append(events.format_event("circle_sizes", cluster_circle_sizes[uuid_param]))
+
+    resp = Response(events.stream(subscriber, initial), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    # Keep reverse proxies from buffering the stream
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+@routes.route('/jobs/<uuid_param>', methods=['GET'])
+def get_jobs(uuid_param):
+    """Clustering job history for a topic, newest first. Clients can wait for the latest job to be done."""
+    jobs = db.get_clustering_jobs(uuid_param)
+    for job in jobs:
+        job["timings"] = json.loads(job["timings"]) if job["timings"] else {}
+        job["queue_wait"] = job["started_at"] - job["queued_at"] if job["started_at"] else None
+        job["compute_time"] = job["finished_at"] - job["started_at"] if job["finished_at"] and job["started_at"] else None
+    return {"jobs": jobs, "latest": jobs[0] if jobs else None}
+
+cluster_processed = summaries.results
+cluster_circle_sizes = summaries.circle_sizes # A dict with the names
 @routes.route('/clusters/<uuid_param>', methods=['GET'])
 def get_clusters(uuid_param):
-    """Get all clustered opinions with their constituent raw opinions and users for a topic"""
+    """
+    Proposed solutions for a topic's clusters. They are generated in the background when a clustering
+    finishes; until the first generation is done this answers 202 with status "pending".
+    """
     
     if uuid_param in cluster_processed.keys():
         return cluster_processed[uuid_param]
@@ -215,15 +284,11 @@ def get_clusters(uuid_param):
     result = db.get_content_by_uuid(uuid_param)
     if not result:
         return {"error": "Topic not found"}, 404
-    
-    clusters = db.get_clustered_opinions_with_raw_opinions(uuid_param)
-    cluster_data = {"clusters": clusters}
-    title, prompt = choose_proposed_solutions(cluster_data)
-    mistral_result = ask_mistral(prompt)
-    result = {"title":title, "mistral_result":mistral_result}
-    cluster_processed[uuid_param] = result
-    cluster_circle_sizes[uuid_param] = {key:50/3 for key in mistral_result.keys()}
-    return result
+
+    summaries.generate(uuid_param)
+    resp = make_response({"status": "pending"}, 202)
+    resp.headers['Retry-After'] = '1'
+    return resp
 
 
 @routes.route('/get_circle_sizes/<uuid_param>', methods=['GET'])
@@ -282,6 +347,7 @@ def update_ball_sizes(uuid_param):
 
     total = sum(adjusted.values())
     cluster_circle_sizes[uuid_param] = {k: v * 50 / total for k, v in adjusted.items()}
+    events.publish(uuid_param, "circle_sizes", cluster_circle_sizes[uuid_param])
 
     return 'worked'
 
@@ -298,6 +364,8 @@ def chat_add():
         return {"error": "Message is required"}, 400
 
     add_message(msg)
+    # The chat is shared by every topic
+    events.publish(None, "chat", {"message": msg})
     return {"status": "ok"}, 200
 
 
@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import database as db
+import events
+import opinion_clustering
+from utils_llm import choose_proposed_solutions, ask_mistral
+
+# Proposed solutions for /clusters, generated by the LLM off the request path. Generation runs at most
+# once per topic at a time: every caller that asks while it runs shares the same future, and a
+# clustering that finishes meanwhile schedules exactly one follow-up run on the newer clusters.
+# The previous result keeps being served until its replacement is ready.
+
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", "2")) # concurrent LLM calls across topics
+LLM_RETRY_AFTER = float(os.getenv("LLM_RETRY_AFTER", "5")) # seconds before a request retries a failed generation
+
+results = {} # topic_uuid -> {"title": ..., "mistral_result": ...}
+circle_sizes = {} # topic_uuid -> {solution: size}, adjusted by the chat
+
+_executor = None
+_in_flight = {} # topic_uuid -> Future
+_stale = set() # topics reclustered while their generation was running
+_failed_at = {} # topic_uuid -> time of the last failed generation
+_lock = threading.Lock()
+_stats = {"generated": 0, "failed": 0, "joined": 0}
+
+def init():
+    """Start the LLM thread pool and regenerate whenever a clustering job finishes"""
+    global _executor
+    _executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="llm")
+    opinion_clustering.add_done_listener(_on_clustered)
+
+def generate(topic_uuid: str, force: bool = False):
+    """
+    Start generating the solutions of a topic, or return the future of the run already in flight.
+    Returns None if the last attempt failed less than LLM_RETRY_AFTER seconds ago, unless forced.
+    """
+    with _lock:
+        future = _in_flight.get(topic_uuid)
+        if future is not None:
+            _stats["joined"] += 1
+            return future
+        if not force and time.time() - _failed_at.get(topic_uuid, 0) < LLM_RETRY_AFTER:
+            return None
+        future = _executor.submit(_generate, topic_uuid)
+        _in_flight[topic_uuid] = future
+    future.add_done_callback(lambda _: _finished(topic_uuid))
+    return future
+
+def _on_clustered(topic_uuid):
+    jobs = db.get_clustering_jobs(topic_uuid, limit=1)
+    if not jobs or jobs[0]["status"] != "done":
+        return
+    # A clustering that left the clusters as they were needs no new solutions
+    if jobs[0]["changes"] == 0 and topic_uuid in results:
+        return
+    with _lock:
+        if topic_uuid in _in_flight:
+            _stale.add(topic_uuid)
+            return
+    generate(topic_uuid, force=True)
+
+def _finished(topic_uuid):
+    with _lock:
+        del _in_flight[topic_uuid]
+        rerun = topic_uuid in _stale
+        _stale.discard(topic_uuid)
+    if rerun:
+        generate(topic_uuid, force=True)
+
+def _generate(topic_uuid):
+    try:
+        clusters = db.get_clustered_opinions_with_raw_opinions(topic_uuid)
+        title, prompt = choose_proposed_solutions({"clusters": clusters})
+        mistral_result = ask_mistral(prompt)
+    except Exception as e:
+        # Nothing is cached, so a later request or the next clustering tries again
+        _stats["failed"] += 1
+        _failed_at[topic_uuid] = time.time()
+        print(f"Generating solutions for {topic_uuid} failed: {e}")
+        raise
+
+    result = {"title": title, "mistral_result": mistral_result}
+    results[topic_uuid] = result
+    # Solutions that survive keep the size the chat gave them
+    previous = circle_sizes.get(topic_uuid, {})
+    circle_sizes[topic_uuid] = {key: previous.get(key, 50 / 3) for key in mistral_result.keys()}
+    _stats["generated"] += 1
+    events.publish(topic_uuid, "clusters", result)
+    events.publish(topic_uuid, "circle_sizes", circle_sizes[topic_uuid])
+    return result
+
+def stats() -> dict:
+    with _lock:
+        return dict(_stats, in_flight=len(_in_flight))
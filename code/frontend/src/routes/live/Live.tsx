@@ -1,30 +1,37 @@
 import Opinion from "./opinion/Opinion";
-import {KeyboardEventHandler, useEffect, useState} from "react";
+import {useEffect, useState} from "react";
 import {useParams} from "react-router";
-import {getLastMessages, getLiveClusters, sendChatMessage, updateBallSizes} from "../../service/fetchService";
+import {getLastMessages, sendChatMessage, subscribeToTopic, toLiveView, updateBallSizes} from "../../service/fetchService";
 import './Live.css'
-import {LiveViewResponse} from "../../service/model/LiveViewResponse";
-import {Message} from "../../service/model/Message";
+import {LiveClusterResponse} from "../../service/LiveClusterResponse";
+import {Dictionary} from "../../service/model/Dictionary";
 
 
 function Live() {
     const {uuid} = useParams();
     const [textbox, setTextbox] = useState("")
-    const [liveView, setLiveView] = useState<LiveViewResponse | undefined>(undefined)
+    const [title, setTitle] = useState("")
+    const [clusters, setClusters] = useState<LiveClusterResponse | undefined>(undefined)
+    const [circleSizes, setCircleSizes] = useState<Dictionary<number>>({})
+    const [messages, setMessages] = useState<string[]>([])
     useEffect(() => {
         if (!uuid) return;
-        startPolling()
-        getLiveClusters(uuid).then(setLiveView)
+        getLastMessages().then(response => setMessages(response.messages))
+        // Pushed by the server instead of polled: the snapshot arrives first, then every change
+        const source = subscribeToTopic(uuid, {
+            onTopic: topic => setTitle(topic.topic),
+            onClusters: setClusters,
+            onCircleSizes: setCircleSizes,
+            onChat: message => {
+                setMessages(previous => [...previous, message].slice(-10))
+                // New chat messages may move the circle sizes, which come back as an event
+                updateBallSizes(uuid)
+            },
+        })
+        return () => source.close()
     }, [uuid])
 
-    function startPolling() {
-        setInterval(() => {
-            if (uuid) {
-                updateBallSizes(uuid)
-                getLiveClusters(uuid).then(setLiveView)
-            }
-        }, 1000)
-    }
+    const liveView = clusters && toLiveView(title, clusters, circleSizes, messages)
 
     function sendMessage(e: React.KeyboardEvent<HTMLInputElement>) {
         if (e.key !== 'Enter') {
@@ -33,10 +40,8 @@ function Live() {
 
         if (liveView) {
             setTextbox("")
+            // Comes back as a chat event like everyone else's messages
             sendChatMessage(textbox)
-            let newMessage: Message = {text: textbox};
-            const extendedSortedMessages: Message[] = liveView.sortedMessages.length > 0 ? [...liveView.sortedMessages, newMessage] : [newMessage]
-            setLiveView({...liveView, sortedMessages: extendedSortedMessages})
         }
     }
 
@@ -67,4 +72,4 @@ function Live() {
     </>
 }
 
-export default Live
\ No newline at end of file
+export default Live
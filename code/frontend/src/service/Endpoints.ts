@@ -11,4 +11,5 @@ export enum Endpoints {
     CHAT_ADD='chat/add',
     CHAT_LAST='chat/last',
     UPDATE_BALL_SIZES='update_ball_sizes',
+    EVENTS='events',
 }
\ No newline at end of file
@@ -102,29 +102,41 @@ export function getClusterCircleSize(uuid: string): Promise<Dictionary<number>>
     })
 }
 
-export async function getLiveClusters(uuid: string): Promise<LiveViewResponse> {
-    const clusterData: LiveClusterResponse = await fetch(`${API_ENDPOINT}/${Endpoints.CLUSTERS}/${uuid}`, {
-        method: 'GET',
-        headers: JSON_HEADER,
-    }).then(res => res.json());
-    const messages = await getLastMessages()
-    const clusterSizeData = new Map<string, number>(Object.entries(await getClusterCircleSize(uuid)));
-const topic = await getTopicInfo(uuid);
-    const solutions: Solution[] = Object.entries(clusterData.mistral_result).map(([key, value]) => {
-        return ({solutionTitle: key, solutionWeight: clusterSizeData.get(key) ?? 0});
+export interface TopicEventHandlers {
+    onTopic: (topic: { topic: string, state: string }) => void,
+    onClusters: (clusters: LiveClusterResponse) => void,
+    onCircleSizes: (circleSizes: Dictionary<number>) => void,
+    onChat: (message: string) => void,
+}
+
+// Server-Sent Events of a topic: a snapshot of its current state first, then every change as it happens.
+// EventSource reconnects on its own; close it when the view goes away.
+export function subscribeToTopic(uuid: string, handlers: TopicEventHandlers): EventSource {
+    const source = new EventSource(`${API_ENDPOINT}/${Endpoints.EVENTS}/${uuid}`);
+    const listen = <T>(event: string, handler: (data: T) => void) =>
+        source.addEventListener(event, e => handler(JSON.parse((e as MessageEvent).data)));
+    listen('topic', handlers.onTopic);
+    listen('clusters', handlers.onClusters);
+    listen('circle_sizes', handlers.onCircleSizes);
+    listen<{ message: string }>('chat', data => handlers.onChat(data.message));
+    return source;
+}
+
+export function toLiveView(problemTitle: string, clusterData: LiveClusterResponse, circleSizes: Dictionary<number>,
+                           messages: string[]): LiveViewResponse {
+    const solutions: Solution[] = Object.keys(clusterData.mistral_result).map(key => {
+        return ({solutionTitle: key, solutionWeight: circleSizes[key] ?? 0});
     })
 
-    const sortedMessages: Message[] = messages.messages.map(m => ({text: m}))
+    const sortedMessages: Message[] = messages.map(m => ({text: m}))
     const opinions: Opinion[] = Object.values(clusterData.mistral_result).map(opinion => ({opinion, author: "-"}))
 
-    const view: LiveViewResponse = ({
-        problemTitle: topic.topic,
-        opinions: opinions,
-        solutions: solutions,
+    return {
+        problemTitle,
+        opinions,
+        solutions,
         sortedMessages
-    })
-
-    return view;
+    }
 }
 
 export function getClusters(uuid: string) {
@@ -1,9 +1,13 @@
 import argparse
+import os
 import pickle
 import random
+import sys
+import time
 from sentence_transformers import SentenceTransformer
 from sklearn.cluster import HDBSCAN, DBSCAN, KMeans, AgglomerativeClustering
 from sklearn.manifold import TSNE
+from sklearn.metrics import adjusted_rand_score
 import numpy as np
 
 # bigger/different embedding model
@@ -153,12 +157,107 @@ def cluster_stage(pickle_dir, corpus_name):
             print(f"[Cluster {label}] {text}")
         print("-" * 50)
 
+def reduce_stage(dims, repeat):
+    # Agreement is measured on the real corpora embedded with the backend's model, clustered at full width
+    # and after each reduction. Speed is timed separately on a scaled set made by tiling the corpora
+    # with noise, which is only good for timing: the copies of a text cluster with each other trivially.
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code', 'backend'))
+    import opinion_clustering
+    from opinion_clustering import reduce_embeddings
+
+    def backend_hdbscan(vectors, metric):
+        return HDBSCAN(min_samples=2, min_cluster_size=2, cluster_selection_method="leaf",
+                       allow_single_cluster=True, metric=metric).fit_predict(vectors)
+
+    print(f"Caveat: every corpus is far below REDUCTION_MIN_OPINIONS={opinion_clustering.REDUCTION_MIN_OPINIONS}, "
+          f"the smallest topic production reduces, so these ARIs say little about production topics.\n")
+    model = opinion_clustering.get_model()
+    corpus_embeddings = []
+    for corpus_name, texts in CORPORA.items():
+        embeddings = np.asarray(model.encode([f"clustering: {text}" for text in texts]), dtype=np.float32)
+        corpus_embeddings.append(embeddings)
+        reference = backend_hdbscan(embeddings, "cosine")
+        print(f"{corpus_name} ({len(texts)} texts, {embeddings.shape[1]} dims): {len(set(reference))} clusters at full width")
+        for method in ["pca", "truncate"]:
+            for dim in dims:
+                # Truncating to the full width keeps everything, and n texts span at most n PCA dimensions
+                lossless = dim >= embeddings.shape[1] or (method == "pca" and dim >= len(texts))
+                if lossless:
+                    print(f"  {method} {dim:>4} dims: skipped, lossless for {len(texts)} texts of {embeddings.shape[1]} dims")
+                    continue
+                labels = backend_hdbscan(reduce_embeddings(embeddings, method, dim), "euclidean")
+                print(f"  {method} {dim:>4} dims: {len(set(labels))} clusters, "
+                      f"ARI vs full width {adjusted_rand_score(reference, labels):.3f}")
+
+    rng = np.random.default_rng(42)
+    base = np.vstack(corpus_embeddings)
+    scaled = np.vstack([base + rng.normal(0, 1e-2, base.shape) for _ in range(repeat)])
+    start = time.perf_counter()
+    backend_hdbscan(scaled, "cosine")
+    reference_time = time.perf_counter() - start
+    print(f"\nScaled set ({len(scaled)} texts), timing only: full width {reference_time:.3f}s")
+    for method in ["pca", "truncate"]:
+        for dim in dims:
+            start = time.perf_counter()
+            backend_hdbscan(reduce_embeddings(scaled, method, dim), "euclidean")
+            elapsed = time.perf_counter() - start
+            print(f"  {method} {dim:>4} dims: {elapsed:.3f}s ({reference_time / elapsed:.1f}x)")
+
+def parity_stage(corpus_name, backend):
+    # Compare a CPU inference backend of the backend's embedder against the fp32 torch model
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code', 'backend'))
+    import opinion_clustering
+
+    texts = [f"clustering: {text}" for text in CORPORA[corpus_name]]
+    results = {}
+    for name in ["torch", backend]:
+        model = opinion_clustering.get_model(backend=name)
+        model.encode(texts[:1])
+        start = time.perf_counter()
+        embeddings = model.encode(texts)
+        elapsed = time.perf_counter() - start
+        labels = HDBSCAN(min_samples=2, min_cluster_size=2, cluster_selection_method="leaf",
+                         allow_single_cluster=True, metric="cosine").fit_predict(embeddings)
+        results[name] = (opinion_clustering.l2_normalize(np.asarray(embeddings, dtype=np.float32)), labels)
+        print(f"{name}: {len(texts) / elapsed:.1f} texts/s, {len(set(labels))} clusters")
+
+    similarities = np.sum(results["torch"][0] * results[backend][0], axis=1)
+    print(f"Cosine similarity {backend} vs torch: mean {similarities.mean():.4f}, min {similarities.min():.4f}")
+    print(f"Cluster agreement (ARI): {adjusted_rand_score(results['torch'][1], results[backend][1]):.3f}")
+
+def edge_stage():
+    # Run the backend's clustering and leader selection on the smallest topics a deadline can produce
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code', 'backend'))
+    import opinion_clustering
+
+    texts = CORPORA["what_blocks_you"]
+    failures = []
+    for count in [0, 1, 2]:
+        opinions = [{"raw_id": i, "username": f"user{i}", "opinion": texts[i], "weight": 1} for i in range(count)]
+        try:
+            labels, multiplicity = opinion_clustering.cluster_labels(opinions)
+            members = opinion_clustering.group_by_label(labels)
+            for strategy in ["softmax", "multiplicity", "top_weight"]:
+                leaders = opinion_clustering.pick_leaders(labels, [o["weight"] for o in opinions],
+                                                          np.random.default_rng(0), strategy, multiplicity)
+                assert set(leaders) == set(members), f"{strategy}: leaders for {sorted(leaders)}, clusters {sorted(members)}"
+                assert all(leader in members[label] for label, leader in leaders.items()), f"{strategy}: leader outside its cluster"
+            print(f"{count} opinions: {len(members)} clusters, ok")
+        except Exception as e:
+            print(f"{count} opinions: FAIL {e!r}")
+            failures.append(count)
+    if failures:
+        raise SystemExit(f"Clustering failed for topics with {failures} opinions")
+
 def main():
     parser = argparse.ArgumentParser(description='Two-stage embedding and clustering testbench')
-    parser.add_argument('mode', choices=['embed', 'cluster'], help='Stage to run')
+    parser.add_argument('mode', choices=['embed', 'cluster', 'reduce', 'parity', 'edge'], help='Stage to run')
     parser.add_argument('--pickle-dir', default='/state', help='Directory for pickle files')
     parser.add_argument('--model', default='google/embeddinggemma-300m', help='Embedding model name')
     parser.add_argument('--corpus', default='what_blocks_you', choices=list(CORPORA.keys()), help='Corpus to use')
+    parser.add_argument('--dims', type=int, nargs='+', default=[16, 32, 64, 128], help='Target dimensions for reduce')
+    parser.add_argument('--repeat', type=int, default=50, help='How often the corpora are tiled for the reduce timing')
+    parser.add_argument('--backend', default='torch-int8', choices=['torch-int8', 'onnx'], help='Backend compared by parity')
 
     args = parser.parse_args()
 
@@ -171,5 +270,14 @@ def main():
     elif args.mode == 'cluster':
         cluster_stage(args.pickle_dir, args.corpus)
 
+    elif args.mode == 'reduce':
+        reduce_stage(args.dims, args.repeat)
+
+    elif args.mode == 'parity':
+        parity_stage(args.corpus, args.backend)
+
+    elif args.mode == 'edge':
+        edge_stage()
+
 if __name__ == '__main__':
     main()